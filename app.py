@@ -1,27 +1,39 @@
 import dataclasses
-from functools import lru_cache
-from typing import Literal
+import hmac
+import itertools
+import multiprocessing
+import os
+import re
+import signal
+import threading
+import time
+from multiprocessing.pool import AsyncResult, ThreadPool
+from typing import Callable, Literal, Optional
 
 import folium
-from flask import Flask, render_template, request, jsonify
-from flask_caching import Cache
+from flask import Flask, render_template, request, jsonify, abort, g
 
+import map_compute
+import metrics
 import ui_config as cfg
 from load_data.load_data import MPKGraphLoader, Stop
+from load_data.timetable import WEEKDAY
+from map_compute import compute_isochrone_map, compute_default_map, compute_isochrone_data, compute_default_data
 from ui.FormData import FormData
 from ui.StopRepository import StopRepository, StopDTO
 
-from map_utils import get_izochrone_map, TransferConfig, _load_stops, get_map
+from map_utils import get_izochrone_map, TransferConfig, _load_stops, get_map, get_stops_data, get_stops_version
+from region_store import get_region_store
 
 
-LOADERS = {
-    "all_2023": MPKGraphLoader.from_pickle('./data/mpk_graph_loader_2023.pkl'),
-    "all_2024": MPKGraphLoader.from_pickle('./data/mpk_graph_loader_2024.pkl'),
-    "tram_2023": MPKGraphLoader.from_pickle('./data/tram_graph_loader_2023.pkl'),
-    "tram_2024": MPKGraphLoader.from_pickle('./data/tram_graph_loader_2024.pkl'),
-    "bus_2023": MPKGraphLoader.from_pickle('./data/bus_graph_loader_2023.pkl'),
-    "bus_2024": MPKGraphLoader.from_pickle('./data/bus_graph_loader_2024.pkl')
-}
+LOADER_PATHS = cfg.LOADER_PATHS
+
+# The server keeps every loader open for the stop search and /stops; map workers open only the ones they use
+for name in LOADER_PATHS:
+    map_compute.open_loader(name)
+
+LOADERS = map_compute.LOADERS
+RESULT_CACHE = map_compute.RESULT_CACHE
 
 STOP_REPOS: dict[Literal['all', 'tram', 'bus'], StopRepository] = {
     "all": StopRepository.from_loaders([LOADERS['all_2023'], LOADERS['all_2024']]),
@@ -31,14 +43,94 @@ STOP_REPOS: dict[Literal['all', 'tram', 'bus'], StopRepository] = {
 
 app_config = {
     "DEBUG": True,  # some Flask specific configs
-    "CACHE_TYPE": "SimpleCache",  # Flask-Caching related configs
-    "CACHE_DEFAULT_TIMEOUT": 300
 }
 
 app = Flask(__name__, template_folder='templates')
 app.config.from_mapping(app_config)
 
-cache = Cache(app)
+
+class _MapPool:
+    # The maps of one page are computed side by side. Worker processes are started from a clean interpreter
+    # (forkserver or spawn), not forked from the threaded server; they import map_compute only and start
+    # with the active scenarios. Each notes the task it is running in arrays shared with the server, so the
+    # worker of a timed-out page can be stopped alone; the pool starts another one in its place.
+
+    def __init__(self) -> None:
+        self.task_ids = itertools.count(1)
+        if cfg.MAP_WORKER_KIND != 'process':
+            self.pids = self.tasks = None
+            self.pool = ThreadPool(cfg.MAP_WORKERS)
+            return
+        context = multiprocessing.get_context(
+            'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        )
+        lock = context.RLock()
+        self.pids = context.Array('q', cfg.MAP_WORKERS, lock=lock)
+        self.tasks = context.Array('q', cfg.MAP_WORKERS, lock=lock)
+        self.pool = context.Pool(cfg.MAP_WORKERS, map_compute.init_worker,
+                                 (map_compute.active_scenarios(), self.pids, self.tasks))
+
+    def submit(self, function: Callable[..., str], args: tuple) -> tuple[int, AsyncResult]:
+        task_id = next(self.task_ids)
+        return task_id, self.pool.apply_async(map_compute.run_task, (task_id, function, *args))
+
+    def stop(self, task_ids: list[int]):
+        # Threads cannot be stopped, a timed-out call of a thread pool runs to its end. A stopped process leaves
+        # its claims on result cache keys behind, they are released so a retry of the page computes right away.
+        if self.pids is None:
+            return
+        with self.pids.get_lock():
+            for slot, pid in enumerate(self.pids):
+                if pid and self.tasks[slot] in task_ids:
+                    try:
+                        os.kill(pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+                    RESULT_CACHE.release_claims(pid)
+                    self.pids[slot] = self.tasks[slot] = 0
+
+    def close(self):
+        # Queued and running calls still finish, then the workers exit
+        self.pool.close()
+
+
+MAP_POOL = _MapPool()
+
+# Held while MAP_POOL is replaced or takes the maps of a page
+_POOL_LOCK = threading.Lock()
+
+
+def _replace_map_pool():
+    # New maps go to a fresh pool, the previous one finishes the calls it was given
+    global MAP_POOL
+    with _POOL_LOCK:
+        previous, MAP_POOL = MAP_POOL, _MapPool()
+    previous.close()
+
+
+def apply_scenario(loader_name: str, scenario: Optional[dict]) -> MPKGraphLoader:
+    # Serves loader_name from a what-if scenario (load_data.scenario.Scenario.to_dict()), or from its base
+    # network again when scenario is None. Cached results need no clearing: their keys hold the fingerprint of
+    # the network they were computed on, so base results are served again once the scenario is reverted.
+    loader = map_compute.serve_scenario(loader_name, scenario)
+    # Workers of the previous pool still serve the previous network, and key their results by it
+    _replace_map_pool()
+    return loader
+
+
+@app.before_request
+def start_timing():
+    g.metrics_token = metrics.begin()
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def add_server_timing(response):
+    stages = metrics.finish(g.pop('metrics_token', None), request.endpoint or 'unknown',
+                            time.perf_counter() - g.request_start)
+    if stages:
+        response.headers['Server-Timing'] = metrics.server_timing(stages)
+    return response
 
 
 @app.route('/')
@@ -49,15 +141,17 @@ def map_view():
     network_kind = request.args.get("network_kind", default="all", type=str)
 
     stop: StopDTO = STOP_REPOS['all'].get_by_id(starting_stop_id)
-    form_data = FormData(stop.id, stop.display_name, transfer_time, stop_reach_max_time)
+    form_data = FormData(stop.id, stop.display_name, transfer_time, stop_reach_max_time, '', WEEKDAY)
 
     # default maps
-    map1 = compute_default_map(stop.name, stop_reach_max_time, transfer_time, f"{network_kind}_2023")
-    map2 = compute_default_map(stop.name, stop_reach_max_time, transfer_time, f"{network_kind}_2024")
+    map1, map2 = _compute_concurrently([
+        (compute_default_map, (stop.name, stop_reach_max_time, transfer_time, f"{network_kind}_2023")),
+        (compute_default_map, (stop.name, stop_reach_max_time, transfer_time, f"{network_kind}_2024")),
+    ])
 
     return render_template(
         'page.html',
-        map1=map1._repr_html_(), map2=map2._repr_html_(),
+        map1=map1, map2=map2,
         map_type="default",
         form_data=form_data
     )
@@ -69,17 +163,23 @@ def iso_map_view():
     transfer_time = request.args.get('transfer_time', default=cfg.DEFAULT_TRANSFER_TIME, type=int)
     stop_reach_max_time = int(request.args.get('stop_reach_max_time', default=cfg.DEFAULT_STOP_REACH_MAX_TIME))
     network_kind = request.args.get("network_kind", default="all", type=str)
+    departure = request.args.get('departure', default='', type=str)
+    day_type = request.args.get('day_type', default=WEEKDAY, type=str)
 
     stop: StopDTO = STOP_REPOS['all'].get_by_id(starting_stop_id)
-    form_data = FormData(stop.id, stop.display_name, transfer_time, stop_reach_max_time)
+    form_data = FormData(stop.id, stop.display_name, transfer_time, stop_reach_max_time, departure, day_type)
 
     # isochrone maps
-    iso_map1 = compute_isochrone_map(stop.name, transfer_time, f"{network_kind}_2023")
-    iso_map2 = compute_isochrone_map(stop.name, transfer_time, f"{network_kind}_2024")
+    departure_time = _parse_departure(departure)
+    _check_departure(departure_time, [f"{network_kind}_2023", f"{network_kind}_2024"])
+    iso_map1, iso_map2 = _compute_concurrently([
+        (compute_isochrone_map, (stop.name, transfer_time, f"{network_kind}_2023", departure_time, day_type)),
+        (compute_isochrone_map, (stop.name, transfer_time, f"{network_kind}_2024", departure_time, day_type)),
+    ])
 
     return render_template(
         'page.html',
-        map1=iso_map1._repr_html_(), map2=iso_map2._repr_html_(),
+        map1=iso_map1, map2=iso_map2,
         map_type="iso",
         form_data=form_data
     )
@@ -91,7 +191,7 @@ def search_stops():
     network_kind = request.args.get('network_kind', default='all', type=str)
 
     assert network_kind in ['all', 'tram', 'bus'], "Invalid network kind"
-    matching_stops: list[StopDTO] = STOP_REPOS[network_kind].query(search_term)
+    matching_stops: list[StopDTO] = STOP_REPOS[network_kind].query(search_term, cfg.STOP_SEARCH_LIMIT)
 
     search_response = [
         {
@@ -112,6 +212,8 @@ def update_map():
     year = request.args.get('year', type=str)
     network_kind = request.args.get('network_kind', type=str)
     map_type = request.args.get('map_type', type=str)
+    departure_time = _parse_departure(request.args.get('departure', default='', type=str))
+    day_type = request.args.get('day_type', default=WEEKDAY, type=str)
 
     loader_name = f"{network_kind}_{year}"  # e.g bus_2023
     assert loader_name in LOADERS.keys()
@@ -119,34 +221,159 @@ def update_map():
     stop = STOP_REPOS[network_kind].get_by_id(starting_stop_id)
 
     if map_type == 'iso':
-        mpk_map = compute_isochrone_map(stop.name, transfer_time, loader_name)
+        _check_departure(departure_time, [loader_name])
+        mpk_map = compute_isochrone_map(stop.name, transfer_time, loader_name, departure_time, day_type)
     elif map_type == 'default':
         mpk_map = compute_default_map(stop.name, stop_reach_max_time, transfer_time, loader_name)
     else:
         raise ValueError(f"Invalid map type: {map_type}")
 
     return jsonify({
-        'map_html': mpk_map._repr_html_(),
+        'map_html': mpk_map,
     })
 
 
-@lru_cache(maxsize=16)
-def compute_isochrone_map(stop_name: str, transfer_time_minutes: int, loader_name: str):
+@app.route("/map_data", methods=["GET"])
+def map_data():
+    # Only what changes between requests; geometry comes from /regions and /stops, cached by the browser
+    starting_stop_id = request.args.get('starting_stop', type=str)
+    transfer_time = request.args.get('transfer_time', type=int)
+    stop_reach_max_time = request.args.get('stop_reach_max_time', type=int)
+    year = request.args.get('year', type=str)
+    network_kind = request.args.get('network_kind', type=str)
+    map_type = request.args.get('map_type', type=str)
+    departure_time = _parse_departure(request.args.get('departure', default='', type=str))
+    day_type = request.args.get('day_type', default=WEEKDAY, type=str)
+
+    loader_name = f"{network_kind}_{year}"  # e.g bus_2023
+    assert loader_name in LOADERS.keys()
+
+    stop = STOP_REPOS[network_kind].get_by_id(starting_stop_id)
+
+    if map_type == 'iso':
+        _check_departure(departure_time, [loader_name])
+        data = compute_isochrone_data(stop.name, transfer_time, loader_name, departure_time, day_type)
+    elif map_type == 'default':
+        data = compute_default_data(stop.name, stop_reach_max_time, transfer_time, loader_name)
+    else:
+        raise ValueError(f"Invalid map type: {map_type}")
+
+    return app.response_class(data, mimetype='application/json')
+
+
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    return jsonify(RESULT_CACHE.stats())
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_view():
+    # Stage histograms are per worker process; result cache counters are shared by all of them
+    if not metrics.ENABLED:
+        abort(404)
+    return app.response_class(metrics.render(RESULT_CACHE.stats()), mimetype='text/plain; version=0.0.4')
+
+
+@app.route("/scenario/<loader_name>", methods=["GET", "PUT", "DELETE"])
+def scenario_view(loader_name: str):
+    # PUT a Scenario.to_dict() body to serve it in place of the network, DELETE to serve the base network again.
+    # Off unless SCENARIO_TOKEN is set; every request carries it in the X-Scenario-Token header.
+    if cfg.SCENARIO_TOKEN is None or loader_name not in LOADERS:
+        abort(404)
+    token = request.headers.get('X-Scenario-Token', '')
+    if not hmac.compare_digest(token.encode(), cfg.SCENARIO_TOKEN.encode()):
+        abort(403)
+    if request.method == 'PUT':
+        scenario = request.get_json(silent=True)
+        if not isinstance(scenario, dict):
+            abort(400)
+        try:
+            apply_scenario(loader_name, scenario)
+        except (ValueError, KeyError, TypeError) as e:
+            return jsonify(error=str(e)), 400
+    elif request.method == 'DELETE':
+        apply_scenario(loader_name, None)
+
     loader = LOADERS[loader_name]
-    return get_izochrone_map(
-        cfg.DEFAULT_REGIONS_RESOLUTION, loader,
-        TransferConfig(stop_name, 5, transfer_time_minutes),
-        [5, 15, 30, 45, 60, 75]
-    )
+    changed = loader.changed_names(cfg.DEFAULT_TRANSFER_TIME) if hasattr(loader, 'changed_names') else set()
+    return jsonify({
+        'loader': loader_name,
+        'scenario': map_compute.active_scenarios().get(loader_name),
+        'stop_names': len(loader.compiled.names),
+        # Stop names whose results differ from the base network at the default transfer time, null for all
+        'changed_names': None if changed is None else len(changed),
+    })
 
 
-@lru_cache(maxsize=16)
-def compute_default_map(stop_name: str, stop_reach_max_time: int, transfer_time_minutes: int, loader_name: str):
+@app.route("/regions/<int:resolution>", methods=["GET"])
+def regions_geojson(resolution: int):
+    if resolution != cfg.DEFAULT_REGIONS_RESOLUTION:
+        abort(404)
+    return _cacheable(jsonify(get_region_store().geojson(resolution)))
+
+
+@app.route("/stops/<loader_name>", methods=["GET"])
+def stops_data(loader_name: str):
+    # Linked from /map_data with ?v=get_stops_version(...): a scenario can change the stop names the answer's ids
+    # index, so only the versioned URL is cached, and an outdated version is gone rather than replaced
+    if loader_name not in LOADERS:
+        abort(404)
     loader = LOADERS[loader_name]
-    return get_map(
-        cfg.DEFAULT_REGIONS_RESOLUTION, loader,
-        TransferConfig(stop_name, stop_reach_max_time, transfer_time_minutes)
-    )
+    version = request.args.get('v')
+    if version is None:
+        response = jsonify(get_stops_data(loader))
+        response.cache_control.no_cache = True
+        response.set_etag(get_stops_version(loader))
+        return response.make_conditional(request)
+    if version != get_stops_version(loader):
+        abort(404)
+    return _cacheable(jsonify(get_stops_data(loader)))
+
+
+def _cacheable(response):
+    # Fixed for its URL; browsers keep it a day and then revalidate with the ETag
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def _compute_concurrently(calls: list[tuple[Callable[..., str], tuple]]) -> list[str]:
+    with _POOL_LOCK:
+        pool = MAP_POOL
+        tasks = [pool.submit(function, args) for function, args in calls]
+    deadline = time.monotonic() + cfg.MAP_TIMEOUT
+    for _, result in tasks:
+        result.wait(max(0.0, deadline - time.monotonic()))
+    not_done = [task_id for task_id, result in tasks if not result.ready()]
+    if not_done:
+        # Only the workers busy with this page's maps are stopped; maps of it still queued run later and
+        # fill the result cache for a retry
+        pool.stop(not_done)
+        abort(504)
+    results = []
+    for _, result in tasks:
+        value, stages = result.get()
+        metrics.merge(stages)
+        results.append(value)
+    return results
+
+
+def _parse_departure(value: str) -> Optional[int]:
+    # "HH:MM" from the form -> minutes after midnight; anything else is a bad request
+    if not value:
+        return None
+    match = re.fullmatch(r'([01]?[0-9]|2[0-3]):([0-5][0-9])', value)
+    if match is None:
+        abort(400)
+    return int(match.group(1)) * 60 + int(match.group(2))
+
+
+def _check_departure(departure_time: Optional[int], loader_names: list[str]):
+    # Timetables are built separately (python -m load_data.build --timetables) and scenarios have none; a
+    # departure time asked of a network without one is refused rather than ignored
+    if departure_time is not None and not all(LOADERS[name].has_timetable for name in loader_names):
+        abort(400)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,25 @@
+import os
+
+import geopandas as gpd
+from shapely.geometry import box
+
+import region_store
+
+# Bounding box of Wroclaw standing in for the geocoded boundary; close enough for timing, not for maps
+WROCLAW_BOUNDS = (16.80, 51.04, 17.18, 51.21)
+REGIONS_DIR = os.path.join('.', 'benchmarks', '.regions')
+
+
+def geocode_stub(area_name: str) -> gpd.GeoDataFrame:
+    return gpd.GeoDataFrame(
+        {'geometry': [box(*WROCLAW_BOUNDS)]},
+        index=gpd.pd.Index([area_name], name='region_id'),
+        crs='EPSG:4326'
+    )
+
+
+def use_offline_regions(regions_dir: str = REGIONS_DIR):
+    # Every map function reads the grid through get_region_store(); pointing that store at its own
+    # directory keeps the stub boundary away from data/regions
+    region_store.geocode_to_region_gdf = geocode_stub
+    region_store.get_region_store().regions_dir = regions_dir
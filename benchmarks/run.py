@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from typing import Callable, Optional
+
+from benchmarks.offline import use_offline_regions
+
+import ui_config as cfg
+from load_data.load_data import MPKGraphLoader
+from map_utils import TransferConfig, get_hex_area, get_izochrone_map, get_map
+from ui.StopRepository import StopRepository
+
+YEARS = ['2023', '2024']
+BASELINE_PATH = os.path.join('.', 'benchmarks', 'baseline.json')
+
+# Busiest stops of the centre and the far ends of the network, present in both years
+ORIGINS = {
+    'centre': ['pl. grunwaldzki', 'galeria dominikańska', 'dworzec główny'],
+    'periphery': ['las mokrzański', 'jarnołtów', 'krępicka'],
+}
+QUERIES = ['p', 'pl', 'grunw', 'plac grunwaldzki', 'dworzec', 'glowna', 'kosciol', 'wroclawska', 'zzz']
+
+
+class Case:
+    def __init__(self, name: str, run: Callable[[], object], repeats: int, warmup: bool = True) -> None:
+        self.name = name
+        self.run = run
+        self.repeats = repeats
+        # Warm runs fill the per-loader and region caches, as a long-running app would have them
+        self.warmup = warmup
+
+    def measure(self) -> dict:
+        if self.warmup:
+            self.run()
+        timings = []
+        for _ in range(self.repeats):
+            start = time.perf_counter()
+            self.run()
+            timings.append(time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            self.run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return {
+            'median_s': statistics.median(timings),
+            'min_s': min(timings),
+            'repeats': self.repeats,
+            'peak_bytes': peak,
+        }
+
+
+def get_cases(resolution: int, repeats: int, ingest: bool) -> list[Case]:
+    cases = []
+    if ingest:
+        for year in YEARS:
+            xml_path = os.path.join('data', f'xmls_{year}')
+            cases.append(Case(f'loader_init[{year}]', lambda path=xml_path: MPKGraphLoader(path, ingest_processes=1),
+                              repeats=1, warmup=False))
+    for year in YEARS:
+        pickle_path = os.path.join('data', f'mpk_graph_loader_{year}.pkl')
+        snapshot_path = os.path.join('data', f'mpk_graph_loader_{year}.snapshot')
+        cases.append(Case(f'loader_from_pickle[{year}]', lambda path=pickle_path: MPKGraphLoader.from_pickle(path),
+                          repeats))
+        cases.append(Case(f'loader_from_snapshot[{year}]',
+                          lambda path=snapshot_path: MPKGraphLoader.from_snapshot(path), repeats))
+
+    loader = MPKGraphLoader.from_pickle(os.path.join('data', f'mpk_graph_loader_{YEARS[-1]}.pkl'))
+    max_time, transfer_time = cfg.DEFAULT_STOP_REACH_MAX_TIME, cfg.DEFAULT_TRANSFER_TIME
+    for kind, names in ORIGINS.items():
+        reach_cfgs = [TransferConfig(name, max_time, transfer_time) for name in names]
+        iso_cfgs = [TransferConfig(name, None, transfer_time) for name in names]
+        cases += [
+            Case(f'get_stops_in_range[{kind}]', lambda cfgs=reach_cfgs: [
+                loader.get_stops_in_range(c.start_name, c.max_time, c.transfer_time) for c in cfgs
+            ], repeats * 10),
+            Case(f'get_map[{kind}]', lambda cfgs=reach_cfgs: [
+                get_map(resolution, loader, c).get_root().render() for c in cfgs
+            ], repeats),
+            Case(f'get_izochrone_map[{kind}]', lambda cfgs=iso_cfgs: [
+                get_izochrone_map(resolution, loader, c, cfg.DEFAULT_STOP_REACH_MAX_TIME_LIST).get_root().render()
+                for c in cfgs
+            ], repeats),
+            Case(f'get_hex_area[{kind}]', lambda cfgs=reach_cfgs: [
+                get_hex_area(resolution, loader, c) for c in cfgs
+            ], repeats * 10),
+        ]
+
+    loaders = [MPKGraphLoader.from_pickle(os.path.join('data', f'mpk_graph_loader_{year}.pkl')) for year in YEARS]
+    cases.append(Case('StopRepository.from_loaders', lambda: StopRepository.from_loaders(loaders), repeats))
+    repository = StopRepository.from_loaders(loaders)
+    cases.append(Case('StopRepository.query', lambda: [repository.query(query) for query in QUERIES], repeats * 100))
+    return cases
+
+
+def compare(results: dict, baseline: dict, threshold: float, min_delta: float) -> list[str]:
+    # A case regresses when its median time or peak memory grows by more than `threshold` of the baseline;
+    # differences under min_delta seconds or 64 KiB are noise
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['median_s'] > base['median_s'] * (1 + threshold) \
+                and result['median_s'] - base['median_s'] > min_delta:
+            regressions.append(f"{name}: {_ms(base['median_s'])} -> {_ms(result['median_s'])}")
+        if result['peak_bytes'] > base['peak_bytes'] * (1 + threshold) \
+                and result['peak_bytes'] - base['peak_bytes'] > 64 * 1024:
+            regressions.append(f"{name}: peak {_kib(base['peak_bytes'])} -> {_kib(result['peak_bytes'])}")
+    return regressions
+
+
+def _ms(seconds: float) -> str:
+    return f'{seconds * 1000:.2f} ms'
+
+
+def _kib(size: int) -> str:
+    return f'{size / 1024:.0f} KiB'
+
+
+def _change(result: dict, base: Optional[dict]) -> str:
+    if base is None:
+        return ''
+    return f"{(result['median_s'] / base['median_s'] - 1) * 100:+.0f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time loader ingest, reachability, map building and stop search '
+                                                 'on the bundled data, offline, and compare with a baseline.')
+    parser.add_argument('-k', '--filter', default='', help='only run cases whose name contains this text')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--resolution', type=int, default=cfg.DEFAULT_REGIONS_RESOLUTION)
+    parser.add_argument('--no-ingest', action='store_true', help='skip parsing the XML dumps')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--output', default=None, help='also write the results to this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed relative slowdown or memory growth, 0.25 by default')
+    parser.add_argument('--min-delta', type=float, default=0.001, help='ignored slowdown in seconds')
+    args = parser.parse_args()
+
+    use_offline_regions()
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    print(f"{'case':<36} {'median':>12} {'min':>12} {'peak':>12} {'change':>6}")
+    for case in get_cases(args.resolution, args.repeats, not args.no_ingest):
+        if args.filter not in case.name:
+            continue
+        results[case.name] = result = case.measure()
+        print(f"{case.name:<36} {_ms(result['median_s']):>12} {_ms(result['min_s']):>12} "
+              f"{_kib(result['peak_bytes']):>12} {_change(result, baseline.get(case.name)):>6}", flush=True)
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    for path in [args.output, args.baseline if args.save_baseline else None]:
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    regressions = compare(results, baseline, args.threshold, args.min_delta)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import argparse
+import os
+import time
+
+from typing import Optional
+
+from load_data.load_data import MPKGraphLoader, TramGraphLoader, BusGraphLoader
+from load_data.timetable import Timetable
+
+
+LOADER_KINDS = {
+    'mpk': MPKGraphLoader,
+    'tram': TramGraphLoader,
+    'bus': BusGraphLoader,
+}
+
+
+def build_loaders(data_dir: str, years: list[str], transfer_time: float = 5.0, processes: int = None,
+                  timetables: bool = False, cache_dir: Optional[str] = None, walk_distance: float = 0.0):
+    for year in years:
+        xml_path = os.path.join(data_dir, f'xmls_{year}')
+        for kind, loader_class in LOADER_KINDS.items():
+            start = time.perf_counter()
+            loader = loader_class(xml_path, transfer_time, ingest_processes=processes, ingest_cache=cache_dir,
+                                  walk_distance=walk_distance)
+            path = os.path.join(data_dir, f'{kind}_graph_loader_{year}.pkl')
+            loader.to_pickle(path)
+            loader.to_snapshot(f'{os.path.splitext(path)[0]}.snapshot')
+            print(f'{path}: {len(loader.multigraph)} stops, {loader.multigraph.number_of_edges()} edges '
+                  f'in {time.perf_counter() - start:.1f} s')
+            if timetables:
+                timetable = Timetable.from_data(xml_path, loader.compiled, processes, cache_dir)
+                timetable_path = Timetable.path_for(path, loader.compiled)
+                timetable.save(timetable_path)
+                print(f'{timetable_path}: {timetable.trips_count} trips')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the graph loader pickles and snapshots from the MPK XML dumps.')
+    parser.add_argument('years', nargs='+', help='data drops to build, e.g. 2023 2024 (reads data/xmls_<year>)')
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--transfer-time', type=float, default=5.0)
+    parser.add_argument('--walk-distance', type=float, default=0.0,
+                        help='add walking transfers between stops at most this many metres apart')
+    parser.add_argument('--processes', type=int, default=None, help='parser processes, all cores by default')
+    parser.add_argument('--timetables', action='store_true', help='also pack departures for timetable-aware routing')
+    parser.add_argument('--cache-dir', default=os.path.join('data', '.ingest_cache'),
+                        help='parsed line files are reused from here when their content did not change')
+    parser.add_argument('--no-cache', action='store_true')
+    args = parser.parse_args()
+    cache_dir = None if args.no_cache else args.cache_dir
+    build_loaders(args.data_dir, args.years, args.transfer_time, args.processes, args.timetables, cache_dir,
+                  args.walk_distance)
+
+
+if __name__ == '__main__':
+    main()
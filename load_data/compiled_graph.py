@@ -0,0 +1,140 @@
+import hashlib
+
+from typing import Iterable, Optional, TYPE_CHECKING
+
+import networkx as nx
+import numpy as np
+
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+if TYPE_CHECKING:
+    from load_data.load_data import Stop
+
+# Edge kinds: `kind` attribute of the networkx edges, index of it in CompiledGraph.kinds
+EDGE_KINDS = ('ride', 'transfer', 'walk')
+RIDE, TRANSFER, WALK = range(len(EDGE_KINDS))
+
+
+class CompiledGraph:
+    # Array-backed view of a loader graph: dense stop ids and CSR edge arrays. times holds the weights baked in
+    # at build time; transfer and walk edges are tagged in kinds so weights() can apply any transfer time.
+
+    def __init__(self, stops: list["Stop"], indptr: np.ndarray, indices: np.ndarray,
+                 times: np.ndarray, kinds: np.ndarray, walk_times: Optional[np.ndarray] = None) -> None:
+        self.stops = stops
+        self.indptr = indptr
+        self.indices = indices
+        self.times = times
+        self.kinds = kinds
+        # Walking minutes of walk edges, 0 elsewhere
+        self.walk_times = np.zeros(len(indices)) if walk_times is None else walk_times
+        self._index: dict["Stop", int] = {stop: i for i, stop in enumerate(stops)}
+        self._name_index: dict[str, list[int]] = {}
+        for i, stop in enumerate(stops):
+            self._name_index.setdefault(stop.name, []).append(i)
+        # Stops of one name share coordinates; names number them in order of first appearance
+        self.names = list(self._name_index.keys())
+        self.name_ids = np.empty(len(stops), dtype=np.int32)
+        for name_id, ids in enumerate(self._name_index.values()):
+            self.name_ids[ids] = name_id
+        self.name_heads = np.array([ids[0] for ids in self._name_index.values()], dtype=np.int64)
+        self._matrices: dict[Optional[float], csr_matrix] = {}
+
+    @staticmethod
+    def from_graph(graph: nx.DiGraph) -> "CompiledGraph":
+        stops = sorted(graph.nodes, key=lambda stop: (stop.line, stop.name))
+        index = {stop: i for i, stop in enumerate(stops)}
+        indptr = np.zeros(len(stops) + 1, dtype=np.int64)
+        indices, times, kinds, walk_times = [], [], [], []
+        for i, stop in enumerate(stops):
+            neighbours = sorted((index[neighbour], edge_data) for neighbour, edge_data in graph[stop].items())
+            for j, edge_data in neighbours:
+                indices.append(j)
+                times.append(edge_data['time'])
+                # Graphs pickled before edges had a kind only changed lines through transfers
+                kind = edge_data.get('kind', 'transfer' if stops[j].line != stop.line else 'ride')
+                kinds.append(EDGE_KINDS.index(kind))
+                walk_times.append(edge_data.get('walk', 0.0))
+            indptr[i + 1] = len(indices)
+        return CompiledGraph(
+            stops, indptr,
+            np.array(indices, dtype=np.int32),
+            np.array(times, dtype=np.float64),
+            np.array(kinds, dtype=np.uint8),
+            np.array(walk_times, dtype=np.float64)
+        )
+
+    def __len__(self) -> int:
+        return len(self.stops)
+
+    @property
+    def edges_count(self) -> int:
+        return len(self.indices)
+
+    @property
+    def transfers(self) -> np.ndarray:
+        # Edges that change lines, transfers at one stop and walks between stops
+        return np.asarray(self.kinds) != RIDE
+
+    @property
+    def fingerprint(self) -> str:
+        digest = hashlib.sha1()
+        digest.update('\n'.join(f'{stop.line}|{stop.name}' for stop in self.stops).encode('utf-8'))
+        # Kinds hash like the transfer flags they replaced, so graphs without walks keep their fingerprint
+        for array in (self.indptr, self.indices, self.times, np.asarray(self.kinds, dtype=np.uint8)):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        if (np.asarray(self.kinds) == WALK).any():
+            digest.update(np.ascontiguousarray(self.walk_times, dtype=np.float64).tobytes())
+        return digest.hexdigest()[:12]
+
+    def index_of(self, stop: "Stop") -> int:
+        return self._index[stop]
+
+    def indices_of(self, name: str) -> np.ndarray:
+        return np.array(self._name_index.get(name, []), dtype=np.int32)
+
+    def weights(self, transfer_time: Optional[float] = None) -> np.ndarray:
+        # A transfer costs transfer_time, a walk its walking time plus transfer_time; None keeps the build weights
+        if transfer_time is None:
+            return self.times
+        return np.where(self.transfers, float(transfer_time) + self.walk_times, self.times)
+
+    def matrix(self, transfer_time: Optional[float] = None) -> csr_matrix:
+        if transfer_time not in self._matrices:
+            n = len(self.stops)
+            self._matrices[transfer_time] = csr_matrix(
+                (self.weights(transfer_time), self.indices, self.indptr), shape=(n, n)
+            )
+        return self._matrices[transfer_time]
+
+    def shortest_times(self, sources: Iterable[int], max_time: float = np.inf,
+                       transfer_time: Optional[float] = None) -> np.ndarray:
+        # One row per source; stops farther than max_time are np.inf
+        sources = np.asarray(list(sources), dtype=np.int32)
+        if len(sources) == 0:
+            return np.empty((0, len(self.stops)))
+        return dijkstra(self.matrix(transfer_time), directed=True, indices=sources, limit=max_time)
+
+    def multi_source_times(self, sources: Iterable[int], max_time: float = np.inf,
+                           transfer_time: Optional[float] = None) -> np.ndarray:
+        # Earliest arrival from any of the sources, all of them starting at time 0
+        sources = np.asarray(list(sources), dtype=np.int32)
+        if len(sources) == 0:
+            return np.full(len(self.stops), np.inf)
+        return dijkstra(self.matrix(transfer_time), directed=True, indices=sources, limit=max_time, min_only=True)
+
+    def reachable(self, sources: Iterable[int], max_time: float,
+                  transfer_time: Optional[float] = None) -> dict["Stop", float]:
+        times = self.multi_source_times(sources, max_time, transfer_time)
+        return self.times_to_stops(times, max_time)
+
+    def name_times(self, times: np.ndarray) -> np.ndarray:
+        # Earliest time over all stops of every name, indexed like self.names
+        ret = np.full(len(self.names), np.inf)
+        np.minimum.at(ret, self.name_ids, times)
+        return ret
+
+    def times_to_stops(self, times: np.ndarray, max_time: float) -> dict["Stop", float]:
+        reached = np.flatnonzero(times <= max_time)
+        return {self.stops[i]: float(times[i]) for i in reached}
@@ -0,0 +1,214 @@
+import dataclasses
+import hashlib
+import os
+import pickle
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import NamedTuple, Optional
+
+from lxml import etree
+from tqdm import tqdm
+
+
+class RouteStop(NamedTuple):
+    name: str
+    code: int
+    time: int  # minutes from the first stop of the variant
+
+
+class StopTimetable(NamedTuple):
+    name: str
+    code: int
+    next_name: Optional[str]  # None for the last stop of a variant
+    next_code: Optional[int]
+    run_time: int  # minutes to the next stop
+    departures: dict[str, list[int]]  # day type -> minutes after midnight
+
+
+@dataclass
+class ParsedLine:
+    path: str
+    name: str
+    variants: dict[int, list[RouteStop]]
+    timetables: Optional[dict[int, list[StopTimetable]]] = None
+
+
+@dataclass
+class IngestResult:
+    lines: list[ParsedLine] = field(default_factory=list)
+    timings: dict[str, float] = field(default_factory=dict)
+    failures: dict[str, str] = field(default_factory=dict)
+    reused: list[str] = field(default_factory=list)
+    rebuilt: list[str] = field(default_factory=list)
+
+    def summary(self, slowest: int = 3) -> str:
+        total = sum(self.timings.values())
+        ret = [f'Parsed {len(self.lines)} of {len(self.timings)} line files, {total:.2f} s of parser time.']
+        if self.reused or self.rebuilt:
+            ret.append(f'  ingest cache: {len(self.reused)} reused, {len(self.rebuilt)} rebuilt')
+        reused = set(self.reused)
+        parsed_timings = [(path, seconds) for path, seconds in self.timings.items() if path not in reused]
+        for path, seconds in sorted(parsed_timings, key=lambda item: -item[1])[:slowest]:
+            ret.append(f'  {seconds:.3f} s  {path}')
+        for path, error in self.failures.items():
+            ret.append(f'  FAILED {path}: {error}')
+        return '\n'.join(ret)
+
+
+# Only these tags are handed back by the parser; timetable subtrees are dropped as soon as they end
+_TAGS = ('linia', 'wariant', 'przystanek', 'czasy', 'tabliczka')
+
+
+def parse_line_file(path: str, timetables: bool = False) -> ParsedLine:
+    name = None
+    variant_id = None
+    variants: dict[int, list[RouteStop]] = {}
+    stop_timetables: dict[int, list[StopTimetable]] = {}
+    stop, next_stop, run_time, departures = None, None, 0, {}
+    for event, element in etree.iterparse(path, events=('start', 'end'), tag=_TAGS):
+        tag = element.tag
+        if event == 'start':
+            if tag == 'linia' and name is None:
+                name = element.get('nazwa')
+            elif tag == 'wariant':
+                variant_id = int(element.get('id'))
+            elif tag == 'przystanek' and element.getparent().tag == 'wariant':
+                stop, next_stop, run_time, departures = (element.get('nazwa'), int(element.get('id'))), None, 0, {}
+            continue
+
+        if tag == 'czasy':
+            route = [
+                RouteStop(route_stop.get('nazwa'), int(route_stop.get('id')), int(route_stop.get('czas')))
+                for route_stop in element.iterchildren('przystanek')
+            ]
+            # The first stop of a variant lists run times for the whole route
+            if variant_id not in variants:
+                variants[variant_id] = route
+            if len(route) > 1:
+                next_stop, run_time = route[1], route[1].time - route[0].time
+            element.clear()
+        elif tag == 'tabliczka':
+            if timetables:
+                for day in element.iterchildren('dzien'):
+                    day_departures = departures.setdefault(day.get('nazwa').lower(), [])
+                    for hour in day.iterchildren('godz'):
+                        h = int(hour.get('h'))
+                        day_departures.extend(h * 60 + int(minute.get('m')) for minute in hour.iterchildren('min'))
+            element.clear()
+        elif tag == 'przystanek' and element.getparent().tag == 'wariant':
+            if timetables:
+                stop_timetables.setdefault(variant_id, []).append(StopTimetable(
+                    stop[0], stop[1],
+                    next_stop.name if next_stop else None, next_stop.code if next_stop else None,
+                    run_time, {day: sorted(minutes) for day, minutes in departures.items()}
+                ))
+            element.clear()
+            parent = element.getparent()
+            while element.getprevious() is not None:
+                del parent[0]
+    if name is None:
+        raise ValueError('no <linia> element')
+    return ParsedLine(path, name, variants, stop_timetables if timetables else None)
+
+
+def _parse_task(path: str, timetables: bool = False) -> tuple[str, Optional[ParsedLine], float, Optional[str]]:
+    start = time.perf_counter()
+    try:
+        parsed, error = parse_line_file(path, timetables), None
+    except Exception as e:
+        parsed, error = None, f'{type(e).__name__}: {e}'
+    return path, parsed, time.perf_counter() - start, error
+
+
+def get_line_paths(data_path: str) -> list[str]:
+    path = os.path.join(data_path, 'lines')
+    return [
+        os.path.join(path, filename, f'{filename}.xml')
+        for filename in sorted(os.listdir(path))
+    ]
+
+
+class IngestCache:
+    # Parsed line files keyed by a hash of their content, so files unchanged between data drops are parsed once
+
+    VERSION = 1  # bump whenever parse_line_file output changes
+
+    def __init__(self, cache_dir: str, timetables: bool = False) -> None:
+        self.cache_dir = cache_dir
+        self.timetables = timetables
+
+    def key(self, path: str) -> str:
+        digest = hashlib.sha1(f'v{self.VERSION}-tt{int(self.timetables)}-'.encode('utf-8'))
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[ParsedLine]:
+        try:
+            with open(self.__path(key), 'rb') as file:
+                return pickle.load(file)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, parsed: ParsedLine):
+        path = self.__path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(parsed, file)
+        os.replace(tmp_path, path)
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.pkl')
+
+
+def ingest_lines(paths: list[str], processes: Optional[int] = None, verbose: bool = True,
+                 timetables: bool = False, cache_dir: Optional[str] = None) -> IngestResult:
+    # One file per task; results are merged in the order of the sorted input paths
+    paths = sorted(paths)
+    result = IngestResult()
+    tasks: dict[str, tuple[str, Optional[ParsedLine], float, Optional[str]]] = {}
+
+    cache = IngestCache(cache_dir, timetables) if cache_dir is not None else None
+    keys: dict[str, str] = {}
+    if cache is not None:
+        for path in paths:
+            keys[path] = cache.key(path)
+            parsed = cache.get(keys[path])
+            if parsed is not None:
+                tasks[path] = (path, dataclasses.replace(parsed, path=path), 0.0, None)
+                result.reused.append(path)
+
+    to_parse = [path for path in paths if path not in tasks]
+    if processes == 1 or len(to_parse) <= 1:
+        results = map(_parse_task, to_parse, [timetables] * len(to_parse))
+        for task in tqdm(results, total=len(to_parse), disable=not verbose):
+            tasks[task[0]] = task
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = executor.map(_parse_task, to_parse, [timetables] * len(to_parse))
+            for task in tqdm(results, total=len(to_parse), disable=not verbose):
+                tasks[task[0]] = task
+
+    if cache is not None:
+        for path in to_parse:
+            parsed = tasks[path][1]
+            if parsed is not None:
+                cache.put(keys[path], parsed)
+                result.rebuilt.append(path)
+
+    for path in paths:
+        _merge(result, *tasks[path])
+    if verbose:
+        print(result.summary())
+    return result
+
+
+def _merge(result: IngestResult, path: str, parsed: Optional[ParsedLine], seconds: float, error: Optional[str]):
+    result.timings[path] = seconds
+    if parsed is not None:
+        result.lines.append(parsed)
+    else:
+        result.failures[path] = error
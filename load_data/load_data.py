@@ -1,13 +1,26 @@
+import itertools
+import math
 import os
 import random
 
+import h3
+import numpy as np
 import pandas as pd
 import networkx as nx
 
-from bs4 import BeautifulSoup, ResultSet
-from tqdm import tqdm
+from scipy.spatial import cKDTree
 from typing import Union, Optional
 
+from load_data.compiled_graph import CompiledGraph
+from load_data.ingest import RouteStop, get_line_paths, ingest_lines
+from load_data.snapshot import CELL_RESOLUTIONS, compiled_from_arrays, graph_from_compiled, read_snapshot, write_snapshot
+from load_data.timetable import Timetable, WEEKDAY
+from load_data.travel_matrix import TravelTimeMatrix
+
+EARTH_RADIUS = 6371008.8
+# Metres per minute, about 4.8 km/h
+WALK_SPEED = 80.0
+
 
 def __random_color() -> str:
     r = random.randint(0, 255)
@@ -22,6 +35,20 @@ def get_line_colors(graph: nx.DiGraph) -> list[str]:
     return [color_map[stop.line] for stop in graph.nodes]
 
 
+def _get_stop_cells(compiled: CompiledGraph, resolution: int) -> np.ndarray:
+    # Stops of one name share coordinates, so h3 (which has no array entry point) runs once per distinct point
+    coords = np.array([
+        (np.nan, np.nan) if pd.isna(stop.lat) or pd.isna(stop.lon) else (stop.lat, stop.lon)
+        for stop in compiled.stops
+    ], dtype=np.float64).reshape(-1, 2)
+    located = ~np.isnan(coords).any(axis=1)
+    points, inverse = np.unique(coords[located], axis=0, return_inverse=True)
+    point_cells = np.array([h3.latlng_to_cell(lat, lon, resolution) for lat, lon in points.tolist()], dtype=str)
+    cells = np.full(len(compiled), '', dtype=point_cells.dtype if len(point_cells) else str)
+    cells[located] = point_cells[inverse.ravel()]
+    return cells
+
+
 class Stop:
 
     __slots__ = ['name', 'code', 'lat', 'lon', 'line']
@@ -51,50 +78,128 @@ class Stop:
 
 
 class MPKGraphLoader:
-    def __init__(self, data_path: str, transfer_time: float = 5.0) -> None:
+    def __init__(self, data_path: str, transfer_time: float = 5.0,
+                 ingest_processes: Optional[int] = None, ingest_cache: Optional[str] = None,
+                 walk_distance: float = 0.0) -> None:
         # Uninitialised 
         if data_path is None:
             self._data_path = None
             self._stops_data = None
+            self._coords_by_name = {}
             self._line_graphs = None
             self._total_graph = None
+            self._compiled = None
+            self._travel_matrices = {}
+            self._timetable = None
+            self._stop_cells = {}
+            self._build_indexes()
             return
         self._data_path = data_path
         self._stops_data = self.__load_stops_df()
-        routes = self.__load_routes()
+        self._coords_by_name: dict[str, tuple[float, float]] = {
+            name: (lat, lon)
+            for name, lat, lon in self._stops_data[['stop_name', 'stop_lat', 'stop_lon']].itertuples(index=False)
+        }
+        routes = self.__load_routes(ingest_processes, ingest_cache)
 
         self._line_graphs: dict[str, nx.DiGraph] = {}
         for line_name, routes_data in routes.items():
+            if not self._include_line(line_name):
+                continue
             line_graph = self.__get_line_graph(*routes_data)
             self._line_graphs[line_name] = line_graph
         
-        self._total_graph = self._get_total_graph(transfer_time)
+        self._total_graph = self._get_total_graph(transfer_time, walk_distance)
+        self._compiled = None
+        self._travel_matrices = {}
+        self._timetable = None
+        self._stop_cells = {}
+        self._build_indexes()
     
     @property
     def multigraph(self) -> nx.DiGraph:
+        # Loaders opened from a snapshot only get the networkx view once something asks for it
+        if self._total_graph is None and getattr(self, '_compiled', None) is not None:
+            self._total_graph = graph_from_compiled(self._compiled)
         return self._total_graph
+
+    @property
+    def compiled(self) -> CompiledGraph:
+        # Built lazily; pickles written before the compiled view existed have no such attribute
+        if getattr(self, '_compiled', None) is None:
+            self._compiled = CompiledGraph.from_graph(self.multigraph)
+        return self._compiled
     
     @property
     def line_names(self) -> list[str]:
-        return list(self._line_graphs.keys())
+        if self._line_graphs is None and getattr(self, '_snapshot_lines', None) is not None:
+            return list(self._snapshot_lines)
+        return list(self._get_line_graphs().keys())
     
     @property
     def tram_line_names(self) -> list[str]:
-        return list(filter(lambda x: not self.is_bus_line(x), self._line_graphs.keys()))
+        return list(filter(lambda x: not self.is_bus_line(x), self.line_names))
     
     @property
     def bus_line_names(self) -> list[str]:
-        return list(filter(self.is_bus_line, self._line_graphs.keys()))
+        return list(filter(self.is_bus_line, self.line_names))
     
     @property
     def stop_names(self) -> list[str]:
-        return list(set(map(lambda stop: stop.name, self.multigraph.nodes)))
+        return list(self._stops_by_name.keys())
     
     def __getitem__(self, line_name: str) -> nx.DiGraph:
-        return self._line_graphs[line_name]
+        return self._get_line_graphs()[line_name]
 
     def get_stop(self, name: str) -> list[Stop]:
-        return list(filter(lambda stop: stop == name, self.multigraph.nodes))
+        return list(self._stops_by_name.get(name, []))
+
+    def get_line_stops(self, line_name: str) -> list[Stop]:
+        return list(self._stops_by_line.get(line_name, []))
+
+    def get_stop_coordinates(self, code: int) -> Optional[tuple[float, float]]:
+        return self._coords_by_code.get(code)
+
+    def _build_indexes(self):
+        self._stops_by_name: dict[str, list[Stop]] = {}
+        self._stops_by_line: dict[str, list[Stop]] = {}
+        self._coords_by_code: dict[int, tuple[float, float]] = {}
+        if self._total_graph is not None:
+            stops = self._total_graph.nodes
+        elif getattr(self, '_compiled', None) is not None:
+            stops = self._compiled.stops
+        else:
+            return
+        for stop in stops:
+            self._stops_by_name.setdefault(stop.name, []).append(stop)
+            self._stops_by_line.setdefault(stop.line, []).append(stop)
+            self._coords_by_code.setdefault(stop.code, (stop.lat, stop.lon))
+
+    def _get_line_graphs(self) -> dict[str, nx.DiGraph]:
+        # Snapshots keep only the total graph; line graphs are its edges within one line
+        if self._line_graphs is None and getattr(self, '_snapshot_lines', None) is not None:
+            line_graphs = {line: nx.DiGraph() for line in self._snapshot_lines}
+            for u, v, time in self.multigraph.edges(data='time'):
+                if u.line == v.line:
+                    line_graphs[u.line].add_edge(u, v, time=time, kind='ride')
+            self._line_graphs = line_graphs
+        return self._line_graphs
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['_total_graph'] = self.multigraph
+        state['_line_graphs'] = self._get_line_graphs()
+        state['_compiled'] = None
+        state['_travel_matrices'] = {}
+        state['_timetable'] = None
+        state['_stop_cells'] = {}
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        # Pickles written before the indexes existed get them rebuilt on load
+        if '_stops_by_name' not in state:
+            self._build_indexes()
 
     def to_pickle(self, path: str):
         import pickle
@@ -107,6 +212,32 @@ class MPKGraphLoader:
         with open(path, 'rb') as file:
             return pickle.load(file)
     
+    def to_snapshot(self, path: str):
+        write_snapshot(path, type(self).__name__, self.compiled, self.line_names,
+                       {resolution: self.stop_cells(resolution) for resolution in CELL_RESOLUTIONS})
+
+    @staticmethod
+    def from_snapshot(path: str) -> "MPKGraphLoader":
+        meta, arrays = read_snapshot(path)
+        loader_classes = {cls.__name__: cls for cls in (MPKGraphLoader, TramGraphLoader, BusGraphLoader)}
+        loader_class = loader_classes[meta['loader']]
+        loader = loader_class.__new__(loader_class)
+        MPKGraphLoader.__init__(loader, None)
+        loader._compiled = compiled_from_arrays(arrays, Stop)
+        loader._snapshot_lines = arrays['lines'].tolist()
+        loader._stop_cells = {
+            int(name[len('stop_cells_'):]): cells for name, cells in arrays.items() if name.startswith('stop_cells_')
+        }
+        loader._build_indexes()
+        return loader
+
+    @staticmethod
+    def from_path(path: str) -> "MPKGraphLoader":
+        # Snapshot directories and pickles are both accepted wherever a loader path is given
+        if os.path.isdir(path):
+            return MPKGraphLoader.from_snapshot(path)
+        return MPKGraphLoader.from_pickle(path)
+
     @staticmethod
     def is_bus_line(name: str):
         if name.isalpha():
@@ -119,16 +250,21 @@ class MPKGraphLoader:
             return True
         return False
     
+    @staticmethod
+    def _include_line(name: str) -> bool:
+        # Subclasses narrow the network to a subset of lines before the graph is assembled
+        return True
+
     def get_tram_liens(self) -> dict[str, nx.DiGraph]:
         ret = {}
-        for name, graph in self._line_graphs.items():
+        for name, graph in self._get_line_graphs().items():
             if not self.is_bus_line(name):
                 ret[name] = graph
         return ret
     
     def get_bus_lines(self) -> dict[str, nx.DiGraph]:
         ret = {}
-        for name, graph in self._line_graphs.items():
+        for name, graph in self._get_line_graphs().items():
             if self.is_bus_line(name):
                 ret[name] = graph
         return ret
@@ -140,35 +276,53 @@ class MPKGraphLoader:
                 ret.add_edge(u, v, time=self.multigraph[u][v])
         return ret
     
-    def get_stops_in_range(self, start_name: str, max_time: float, transfer_time: Optional[float] = None) -> list[Stop]:
-        stops = list(filter(lambda stop: stop == start_name, self.multigraph.nodes))
-        ret = set()
-        for stop in stops:
-            accessible_stops = self.__find_accessible_stops(stop, max_time, transfer_time=transfer_time)
-            ret.update(accessible_stops)
-        return ret
-    
-    def __find_accessible_stops(self, start: Stop, max_time: float, transfer_time: Optional[float] = None) -> set[Stop]:
-        queue = [
-            (neighbour, edge_data['time']) if transfer_time is None or neighbour.line == start.line else (neighbour, transfer_time)
-            for neighbour, edge_data
-            in self.multigraph[start].items()
-        ]
-        visited_stops = set()
-        accessible_stops = []
-
-        while queue:
-            current_stop, current_time = queue.pop(0)
-            if current_stop not in visited_stops:
-                visited_stops.add(current_stop)
-                if current_time <= max_time:
-                    accessible_stops.append(current_stop)
-                    for neighbour, edge_data in self.multigraph[current_stop].items():
-                        travel_time = edge_data['time'] if transfer_time is None or neighbour.line == current_stop.line else transfer_time
-                        queue.append((neighbour, current_time + travel_time))
-        return accessible_stops
+    def attach_travel_matrices(self, loader_path: str) -> list[float]:
+        # Memory-maps the precomputed matrices built for this exact graph next to the loader at loader_path
+        matrices = TravelTimeMatrix.find(loader_path, self.compiled)
+        self._travel_matrices = {matrix.transfer_time: matrix for matrix in matrices}
+        return list(self._travel_matrices.keys())
+
+    def attach_timetable(self, loader_path: str) -> bool:
+        # Loads the departures packed for this exact graph next to the loader at loader_path, if they were built
+        self._timetable = Timetable.find(loader_path, self.compiled)
+        return self._timetable is not None
+
+    @property
+    def has_timetable(self) -> bool:
+        return getattr(self, '_timetable', None) is not None
+
+    def get_stops_in_range(self, start_name: str, max_time: float, transfer_time: Optional[float] = None,
+                           departure_time: Optional[int] = None, day_type: str = WEEKDAY) -> dict[Stop, float]:
+        times = self.get_times_in_range(start_name, max_time, transfer_time, departure_time, day_type)
+        return self.compiled.times_to_stops(times, max_time)
+
+    def get_times_in_range(self, start_name: str, max_time: float, transfer_time: Optional[float] = None,
+                           departure_time: Optional[int] = None, day_type: str = WEEKDAY) -> np.ndarray:
+        # Travel times indexed like compiled.stops; only values up to max_time are meaningful
+        compiled = self.compiled
+        sources = compiled.indices_of(start_name)
+        if departure_time is not None:
+            if not self.has_timetable:
+                raise ValueError('Timetable-aware search needs a timetable, see MPKGraphLoader.attach_timetable.')
+            return self._timetable.earliest_arrival(sources, departure_time, day_type, max_time, transfer_time)
+        matrix = getattr(self, '_travel_matrices', {}).get(transfer_time)
+        if matrix is not None and len(sources) > 0:
+            return matrix.times_from(sources)
+        return compiled.multi_source_times(sources, max_time, transfer_time=transfer_time)
+
+    def result_fingerprint(self, stop_name: str, transfer_time: Optional[float] = None) -> str:
+        # Identifies the network a cached result for stop_name was computed on, see ScenarioLoader
+        return self.compiled.fingerprint
+
+    def stop_cells(self, resolution: int) -> np.ndarray:
+        # H3 cell of every compiled stop, '' for stops without coordinates; stored in snapshots, otherwise
+        # computed once per resolution
+        if getattr(self, '_stop_cells', None) is None:
+            self._stop_cells = {}
+        if resolution not in self._stop_cells:
+            self._stop_cells[resolution] = _get_stop_cells(self.compiled, resolution)
+        return self._stop_cells[resolution]
 
-    
     def __load_stops_df(self) -> pd.DataFrame:
         df_path = os.path.join(self._data_path, 'stops.txt')
         stops_df = pd.read_csv(df_path)
@@ -181,48 +335,35 @@ class MPKGraphLoader:
         data = coords.join(codes.set_index('stop_name'), on='stop_name')
         return data
     
-    def __load_routes(self) -> dict[str, tuple[list[Stop], list[Stop], list[int], list[int]]]:
+    def __load_routes(self, processes: Optional[int] = None,
+                      cache_dir: Optional[str] = None) -> dict[str, tuple[list[Stop], list[Stop], list[int], list[int]]]:
         ret = {}
-        xml_paths = self.__get_xml_paths()
-        for path in tqdm(xml_paths):
-            line_name, var1, var2 = self.__load_line_variants_from_xml(path)
-            stop_list_var1, route_times1 = self.__get_stop_list(line_name, var1)
-            stop_list_var2, route_times2 = self.__get_stop_list(line_name, var2)
+        ingested = ingest_lines(get_line_paths(self._data_path), processes=processes, cache_dir=cache_dir)
+        for parsed in ingested.lines:
+            line_name = parsed.name.lower()
+            if 1 not in parsed.variants or 2 not in parsed.variants:
+                print(f'WARNING: line {line_name} ({parsed.path}) does not have both route variants, skipping.')
+                continue
+            stop_list_var1, route_times1 = self.__get_stop_list(line_name, parsed.variants[1])
+            stop_list_var2, route_times2 = self.__get_stop_list(line_name, parsed.variants[2])
             ret[line_name] = (stop_list_var1, stop_list_var2, route_times1, route_times2)
         return ret
     
-    def __get_xml_paths(self) -> list[str]:
-        path = os.path.join(self._data_path, 'lines')
-        xmls = []
-        for filename in os.listdir(path):
-            full_path = os.path.join(path, filename, f'{filename}.xml')
-            xmls.append(full_path)
-        return xmls
-    
-    def __load_line_variants_from_xml(self, xml_path: str) -> tuple[str, ResultSet, ResultSet]:
-        with open(xml_path, 'r', encoding='utf-8') as file:
-            data = file.read()
-        data = BeautifulSoup(data, 'xml')
-        name = data.find('linie').find('linia').get('nazwa').lower()
-        stops1_xml = data.find('linie').find('wariant', {'id': 1}).find('czasy').find_all('przystanek')
-        stops2_xml = data.find('linie').find('wariant', {'id': 2}).find('czasy').find_all('przystanek')
-        return name, stops1_xml, stops2_xml
-    
-    def __get_stop_list(self, line_name: str, stops_xml: list) -> tuple[list[Stop], list[int]]:
+    def __get_stop_list(self, line_name: str, route: list[RouteStop]) -> tuple[list[Stop], list[int]]:
         ret = []
         times = []
         errs_count = 0
         delta_time = 0
-        for i, stop in enumerate(stops_xml):
-            name = stop.get('nazwa').lower()
-            code = int(stop.get('id'))
+        for i, stop in enumerate(route):
+            name = stop.name.lower()
+            code = stop.code
             time = 0
             if i != 0:
-                time = int(stop.get('czas')) - delta_time
+                time = stop.time - delta_time
                 delta_time += time
             try:
-                lat, lon = self._stops_data.loc[self._stops_data['stop_name'] == name, ['stop_lat', 'stop_lon']].values[0]
-            except IndexError:
+                lat, lon = self._coords_by_name[name]
+            except KeyError:
                 lat, lon = None, None
                 errs_count += 1
             s = Stop(name, code, lat, lon, line_name)
@@ -246,50 +387,66 @@ class MPKGraphLoader:
             t: int = times[i]
             graph.add_node(u)
             graph.add_node(v)
-            graph.add_edge(u, v, time=t)
+            graph.add_edge(u, v, time=t, kind='ride')
         return graph
     
-    def _get_total_graph(self, transfer_time: float) -> nx.DiGraph:
+    def _get_total_graph(self, transfer_time: float, walk_distance: float = 0.0) -> nx.DiGraph:
+        # Edges have a kind: rides along a line, transfers between lines at one stop and, with walk_distance,
+        # walks to the lines of stops at most that many metres away. Transfer and walk times are baked in for
+        # the given transfer_time; CompiledGraph.weights() applies any other one at query time.
         ret = nx.DiGraph()
-        for line1, line_1_graph in self._line_graphs.items():
-            for line2, line_2_graph in self._line_graphs.items():
-                if line1 != line2:
-                    for u, v in line_1_graph.edges:
-                        ret.add_edge(u, v, time=line_1_graph[u][v]['time'])
-                    for u, v in line_2_graph.edges:
-                        ret.add_edge(u, v, time=line_2_graph[u][v]['time'])
-
-                    line1_stop_names = set(map(lambda stop: stop.name, line_1_graph.nodes))
-                    line2_stop_names = set(map(lambda stop: stop.name, line_2_graph.nodes))
-                    common_names = line1_stop_names & line2_stop_names
-                    for name in common_names:
-                        line1_stop = list(filter(lambda stop: stop == name, line_1_graph.nodes))[0]
-                        line2_stop = list(filter(lambda stop: stop == name, line_2_graph.nodes))[0]
-                        ret.add_edge(line1_stop, line2_stop, time=transfer_time)
-                        ret.add_edge(line2_stop, line1_stop, time=transfer_time)
+        # name -> line -> stops of that line carrying the name
+        stops_by_name: dict[str, dict[str, list[Stop]]] = {}
+        for line_name, line_graph in self._line_graphs.items():
+            ret.add_edges_from(line_graph.edges(data=True))
+            for stop in line_graph.nodes:
+                stops_by_name.setdefault(stop.name, {}).setdefault(line_name, []).append(stop)
+
+        for lines in stops_by_name.values():
+            if len(lines) < 2:
+                continue
+            # Stops are keyed by (name, line), so each line has exactly one stop of the name
+            for stops1, stops2 in itertools.combinations(lines.values(), 2):
+                u, v = stops1[0], stops2[0]
+                ret.add_edge(u, v, time=transfer_time, kind='transfer')
+                ret.add_edge(v, u, time=transfer_time, kind='transfer')
+        if walk_distance > 0:
+            self.__add_walks(ret, stops_by_name, transfer_time, walk_distance)
         ret.remove_edges_from(nx.selfloop_edges(ret))
         return ret
+
+    @staticmethod
+    def __add_walks(graph: nx.DiGraph, stops_by_name: dict[str, dict[str, list[Stop]]], transfer_time: float,
+                    walk_distance: float):
+        # Pairs of stop names within walk_distance come from a k-d tree over coordinates projected to metres
+        # (equirectangular, exact enough over a city); the walk takes whole minutes at WALK_SPEED
+        heads = {name: next(iter(lines.values()))[0] for name, lines in stops_by_name.items()}
+        names = [name for name, stop in heads.items() if not (pd.isna(stop.lat) or pd.isna(stop.lon))]
+        if len(names) < 2:
+            return
+        coords = np.radians([(heads[name].lat, heads[name].lon) for name in names])
+        latitude = coords[:, 0].mean()
+        points = EARTH_RADIUS * np.column_stack([coords[:, 1] * np.cos(latitude), coords[:, 0]])
+        pairs = cKDTree(points).query_pairs(walk_distance, output_type='ndarray')
+        distances = np.linalg.norm(points[pairs[:, 0]] - points[pairs[:, 1]], axis=1)
+        for (i, j), distance in zip(pairs.tolist(), distances.tolist()):
+            walk = max(1, math.ceil(distance / WALK_SPEED))
+            for line1, stops1 in stops_by_name[names[i]].items():
+                for line2, stops2 in stops_by_name[names[j]].items():
+                    # Stops of one line are connected by riding it
+                    if line1 == line2:
+                        continue
+                    graph.add_edge(stops1[0], stops2[0], time=transfer_time + walk, kind='walk', walk=walk)
+                    graph.add_edge(stops2[0], stops1[0], time=transfer_time + walk, kind='walk', walk=walk)
     
 
 class TramGraphLoader(MPKGraphLoader):
-    def __init__(self, data_path: str, transfer_time: float = 5) -> None:
-        super().__init__(data_path, transfer_time)
-        tram_graphs = {
-            line_name: graph
-            for line_name, graph in self._line_graphs.items()
-            if not TramGraphLoader.is_bus_line(line_name)
-        }
-        self._line_graphs = tram_graphs
-        self._total_graph = self._get_total_graph(transfer_time)
+    @staticmethod
+    def _include_line(name: str) -> bool:
+        return not TramGraphLoader.is_bus_line(name)
 
 
 class BusGraphLoader(MPKGraphLoader):
-    def __init__(self, data_path: str, transfer_time: float = 5) -> None:
-        super().__init__(data_path, transfer_time)
-        tram_graphs = {
-            line_name: graph
-            for line_name, graph in self._line_graphs.items()
-            if BusGraphLoader.is_bus_line(line_name)
-        }
-        self._line_graphs = tram_graphs
-        self._total_graph = self._get_total_graph(transfer_time)
+    @staticmethod
+    def _include_line(name: str) -> bool:
+        return BusGraphLoader.is_bus_line(name)
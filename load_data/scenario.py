@@ -0,0 +1,415 @@
+import argparse
+import hashlib
+import json
+import time
+
+from typing import Optional
+
+import numpy as np
+
+from load_data.compiled_graph import RIDE, TRANSFER, CompiledGraph
+from load_data.load_data import MPKGraphLoader, Stop
+from load_data.timetable import WEEKDAY
+from load_data.travel_matrix import UNREACHABLE, TravelTimeMatrix
+
+EDGE_CHUNK = 256
+
+
+class Scenario:
+    # What-if edits of a base loader's network: disabled and added lines, segment times and the transfer penalty.
+    # loader() builds the edited network; its searches reuse the base travel time matrices for every origin the
+    # edits cannot reach, see IncrementalTravelTimes.
+
+    def __init__(self, base: MPKGraphLoader) -> None:
+        self.base = base
+        self.disabled_lines: set[str] = set()
+        self.added_lines: dict[str, tuple[list[str], list[float], bool]] = {}
+        self.segment_times: dict[tuple[str, str, str], float] = {}
+        self.transfer_time: Optional[float] = None
+
+    def disable_line(self, line: str) -> "Scenario":
+        if line not in self.base.line_names:
+            raise ValueError(f'Unknown line {line}.')
+        self.disabled_lines.add(line)
+        return self
+
+    def add_line(self, line: str, stop_names: list[str], times: list[float], both_directions: bool = True) -> "Scenario":
+        # A line through existing stops, times[i] minutes from stop_names[i] to stop_names[i + 1]; it gets
+        # transfers to every other line of its stops
+        if line in self.base.line_names and line not in self.disabled_lines:
+            raise ValueError(f'Line {line} already exists, disable it first to replace it.')
+        if len(stop_names) < 2 or len(times) != len(stop_names) - 1:
+            raise ValueError('A line needs at least two stops and one time between every two of them.')
+        unknown = [name for name in stop_names if not self.base.get_stop(name)]
+        if unknown:
+            raise ValueError(f'Unknown stops: {", ".join(unknown)}.')
+        self.added_lines[line] = (list(stop_names), [float(t) for t in times], both_directions)
+        return self
+
+    def set_segment_time(self, line: str, from_name: str, to_name: str, minutes: float) -> "Scenario":
+        compiled = self.base.compiled
+        try:
+            source = compiled.index_of(Stop(from_name, 0, None, None, line))
+            target = compiled.index_of(Stop(to_name, 0, None, None, line))
+        except KeyError:
+            raise ValueError(f'Line {line} does not stop at both {from_name} and {to_name}.')
+        if target not in compiled.indices[compiled.indptr[source]:compiled.indptr[source + 1]]:
+            raise ValueError(f'Line {line} does not go from {from_name} straight to {to_name}.')
+        self.segment_times[(line, from_name, to_name)] = float(minutes)
+        return self
+
+    def set_transfer_time(self, minutes: Optional[float]) -> "Scenario":
+        # Used by every search on the scenario in place of the transfer time asked for
+        self.transfer_time = None if minutes is None else float(minutes)
+        return self
+
+    def to_dict(self) -> dict:
+        return {
+            'disabled_lines': sorted(self.disabled_lines),
+            'added_lines': {line: {'stops': names, 'times': times, 'both_directions': both}
+                            for line, (names, times, both) in self.added_lines.items()},
+            'segment_times': [[line, a, b, minutes] for (line, a, b), minutes in self.segment_times.items()],
+            'transfer_time': self.transfer_time,
+        }
+
+    @staticmethod
+    def from_dict(base: MPKGraphLoader, data: dict) -> "Scenario":
+        scenario = Scenario(base)
+        for line in data.get('disabled_lines', []):
+            scenario.disable_line(line)
+        for line, added in data.get('added_lines', {}).items():
+            scenario.add_line(line, added['stops'], added['times'], added.get('both_directions', True))
+        for line, a, b, minutes in data.get('segment_times', []):
+            scenario.set_segment_time(line, a, b, minutes)
+        scenario.set_transfer_time(data.get('transfer_time'))
+        return scenario
+
+    def compile(self) -> tuple[CompiledGraph, np.ndarray]:
+        # The edited graph and, for each of its stops, the index of the same stop in the base graph (-1 for
+        # stops of added lines). Stops are ordered by the base order of their names, so the names of the
+        # scenario keep the base order and ids while none of them disappears.
+        base = self.base.compiled
+        n = len(base)
+        kept = np.array([stop.line not in self.disabled_lines for stop in base.stops], dtype=bool)
+        edge_sources = np.repeat(np.arange(n), np.diff(base.indptr))
+        edge_targets = np.asarray(base.indices, dtype=np.int64)
+        times = self._edited_times(base)
+        kept_edges = kept[edge_sources] & kept[edge_targets]
+
+        stops = [base.stops[i] for i in np.flatnonzero(kept)]
+        base_index = list(np.flatnonzero(kept))
+        position = {stop: i for i, stop in enumerate(stops)}
+        sources = [edge_sources[kept_edges]]
+        targets = [edge_targets[kept_edges]]
+        weights = [times[kept_edges]]
+        kinds = np.asarray(base.kinds)[kept_edges]
+        walk_times = np.asarray(base.walk_times)[kept_edges]
+
+        added_sources, added_targets, added_weights, added_kinds = [], [], [], []
+        for line, (names, line_times, both_directions) in self.added_lines.items():
+            for name in names:
+                stop = Stop(name, 0, None, None, line)
+                if stop not in position:
+                    head = self.base.get_stop(name)[0]
+                    position[stop] = len(stops)
+                    stops.append(Stop(name, head.code, head.lat, head.lon, line))
+                    base_index.append(-1)
+            for (a, b), minutes in zip(zip(names, names[1:]), line_times):
+                u, v = position[Stop(a, 0, None, None, line)], position[Stop(b, 0, None, None, line)]
+                added_sources.append(u)
+                added_targets.append(v)
+                added_weights.append(minutes)
+                added_kinds.append(RIDE)
+                if both_directions:
+                    added_sources.append(v)
+                    added_targets.append(u)
+                    added_weights.append(minutes)
+                    added_kinds.append(RIDE)
+
+        # Transfers from the stops of added lines to every other line stopping there, both ways
+        base_transfers = np.asarray(base.kinds) == TRANSFER
+        transfer_weight = float(base.times[base_transfers][0]) if base_transfers.any() else 5.0
+        stops_by_name: dict[str, list[int]] = {}
+        for i, stop in enumerate(stops):
+            stops_by_name.setdefault(stop.name, []).append(i)
+        transfers = set()
+        for i in range(len(base_index)):
+            if base_index[i] >= 0:
+                continue
+            for j in stops_by_name[stops[i].name]:
+                if stops[j].line != stops[i].line:
+                    transfers.update([(i, j), (j, i)])
+        for u, v in sorted(transfers):
+            added_sources.append(u)
+            added_targets.append(v)
+            added_weights.append(transfer_weight)
+            added_kinds.append(TRANSFER)
+
+        base_index = np.array(base_index, dtype=np.int64)
+        new_position = np.full(n, -1, dtype=np.int64)
+        new_position[base_index[base_index >= 0]] = np.arange(len(base_index))[base_index >= 0]
+        sources = np.concatenate([new_position[sources[0]], np.array(added_sources, dtype=np.int64)])
+        targets = np.concatenate([new_position[targets[0]], np.array(added_targets, dtype=np.int64)])
+        weights = np.concatenate([weights[0], np.array(added_weights, dtype=np.float64)])
+        kinds = np.concatenate([kinds, np.array(added_kinds, dtype=np.uint8)])
+        walk_times = np.concatenate([walk_times, np.zeros(len(added_kinds))])
+
+        name_rank = {name: i for i, name in enumerate(base.names)}
+        order = sorted(range(len(stops)), key=lambda i: (name_rank[stops[i].name], stops[i].line))
+        rank = np.empty(len(stops), dtype=np.int64)
+        rank[order] = np.arange(len(stops))
+        sources, targets = rank[sources], rank[targets]
+        edges = np.lexsort((targets, sources))
+        stops = [stops[i] for i in order]
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=len(stops)))])
+        compiled = CompiledGraph(
+            stops, indptr.astype(np.int64),
+            targets[edges].astype(np.int32),
+            weights[edges],
+            kinds[edges],
+            walk_times[edges]
+        )
+        return compiled, base_index[order]
+
+    def loader(self) -> "ScenarioLoader":
+        compiled, base_index = self.compile()
+        loader = ScenarioLoader.__new__(ScenarioLoader)
+        MPKGraphLoader.__init__(loader, None)
+        loader._compiled = compiled
+        lines = [line for line in self.base.line_names if line not in self.disabled_lines]
+        loader._snapshot_lines = lines + [line for line in self.added_lines if line not in lines]
+        loader._build_indexes()
+        loader._transfer_time = self.transfer_time
+        loader._base_fingerprint = self.base.compiled.fingerprint
+        spec = json.dumps(self.to_dict(), sort_keys=True, ensure_ascii=False)
+        loader._fingerprint = hashlib.sha1(f'{compiled.fingerprint}|{spec}'.encode('utf-8')).hexdigest()[:12]
+        loader._changed_names = {}
+        for transfer_time, matrix in getattr(self.base, '_travel_matrices', {}).items():
+            added_times = self.added_stop_times(compiled, base_index, matrix)
+            affected = self.affected_stops(compiled, base_index, matrix, added_times)
+            loader._travel_matrices[transfer_time] = IncrementalTravelTimes(compiled, matrix, base_index, affected,
+                                                                            added_times)
+            loader._changed_names[transfer_time] = self._changed_names(compiled, base_index, affected, matrix,
+                                                                       added_times)
+        return loader
+
+    def affected_stops(self, compiled: CompiledGraph, base_index: np.ndarray, matrix: TravelTimeMatrix,
+                       added_times: Optional[np.ndarray] = None) -> np.ndarray:
+        # Stops of the scenario whose row of the base matrix may differ in the scenario. Origin s keeps its row
+        # unless a slower or removed edge u->v lies on one of its shortest paths (D[s,u] + w == D[s,v]), or a
+        # faster edge or a way back from an added line shortens one (D[s,u] + w' < D[s,v]).
+        base = self.base.compiled
+        n = len(base)
+        kept = np.zeros(n, dtype=bool)
+        kept[base_index[base_index >= 0]] = True
+        edge_sources = np.repeat(np.arange(n), np.diff(base.indptr))
+        edge_targets = np.asarray(base.indices, dtype=np.int64)
+        old = base.weights(matrix.transfer_time)
+        new = np.where(base.transfers, old, self._edited_times(base))
+        # A shortest path through removed stops comes back to the network through a removed edge into a kept
+        # stop, so only those removed edges are checked
+        new[~(kept[edge_sources] & kept[edge_targets])] = np.inf
+        changed = np.flatnonzero((new != old) & kept[edge_targets])
+
+        affected = np.zeros(n, dtype=bool)
+        scenario_weights = compiled.weights(matrix.transfer_time)
+        if not (_whole_minutes(old) and _whole_minutes(new[np.isfinite(new)]) and _whole_minutes(scenario_weights)):
+            # The matrix holds times rounded up to whole minutes, only exact for whole-minute edges
+            affected[:] = True
+        for start in range(0, len(changed) if not affected.all() else 0, EDGE_CHUNK):
+            edges = changed[start:start + EDGE_CHUNK]
+            to_source = _distances(matrix, edge_sources[edges])
+            to_target = _distances(matrix, edge_targets[edges])
+            slower = new[edges] > old[edges]
+            on_path = np.isfinite(to_source) & (to_source + old[edges] == to_target)
+            shortcut = to_source + new[edges] < to_target
+            affected |= np.where(slower, on_path, shortcut).any(axis=1)
+
+        # Edges from the stops of added lines back to the base stops, shortcuts when they arrive before D[s,v]
+        new_stops = np.flatnonzero(base_index < 0)
+        if len(new_stops) and not affected.all():
+            if added_times is None:
+                added_times = self.added_stop_times(compiled, base_index, matrix)
+            column = np.full(len(compiled), -1, dtype=np.int64)
+            column[new_stops] = np.arange(len(new_stops))
+            sources = np.repeat(np.arange(len(compiled)), np.diff(compiled.indptr))
+            targets = np.asarray(compiled.indices, dtype=np.int64)
+            exits = np.flatnonzero((base_index[sources] < 0) & (base_index[targets] >= 0))
+            for start in range(0, len(exits), EDGE_CHUNK):
+                edges = exits[start:start + EDGE_CHUNK]
+                to_target = _distances(matrix, base_index[targets[edges]])
+                affected |= (added_times[:, column[sources[edges]]] + scenario_weights[edges] < to_target).any(axis=1)
+
+        ret = np.ones(len(compiled), dtype=bool)
+        ret[base_index >= 0] = affected[base_index[base_index >= 0]]
+        return ret
+
+    def added_stop_times(self, compiled: CompiledGraph, base_index: np.ndarray,
+                         matrix: TravelTimeMatrix) -> np.ndarray:
+        # Minutes from every base stop (rows) to every stop of an added line (columns, in scenario order), np.inf
+        # where unreachable: D[s,u] + w along an edge u->a into the added stops, then along the added lines. Exact
+        # for the origins affected_stops leaves out.
+        new_stops = np.flatnonzero(base_index < 0)
+        column = np.full(len(compiled), -1, dtype=np.int64)
+        column[new_stops] = np.arange(len(new_stops))
+        weights = compiled.weights(matrix.transfer_time)
+        sources = np.repeat(np.arange(len(compiled)), np.diff(compiled.indptr))
+        targets = np.asarray(compiled.indices, dtype=np.int64)
+        into_new = base_index[targets] < 0
+
+        # Shortest times between the added stops, over edges among them only
+        between = np.full((len(new_stops), len(new_stops)), np.inf)
+        np.fill_diagonal(between, 0)
+        for edge in np.flatnonzero(into_new & (base_index[sources] < 0)):
+            u, v = column[sources[edge]], column[targets[edge]]
+            between[u, v] = min(between[u, v], weights[edge])
+        for k in range(len(new_stops)):
+            np.minimum(between, between[:, k, None] + between[None, k, :], out=between)
+
+        times = np.full((len(self.base.compiled), len(new_stops)), np.inf)
+        entries = np.flatnonzero(into_new & (base_index[sources] >= 0))
+        for start in range(0, len(entries), EDGE_CHUNK):
+            edges = entries[start:start + EDGE_CHUNK]
+            to_source = _distances(matrix, base_index[sources[edges]])
+            for i, edge in enumerate(edges):
+                np.minimum(times, to_source[:, i, None] + weights[edge] + between[column[targets[edge]]], out=times)
+        return times
+
+    def _changed_names(self, compiled: CompiledGraph, base_index: np.ndarray, affected: np.ndarray,
+                       matrix: TravelTimeMatrix, added_times: np.ndarray) -> Optional[set[str]]:
+        # Names whose results may differ from the base ones: an affected stop, a stop removed from the origins,
+        # or a name whose earliest stop changes because it lost or gained stops. None when the names themselves
+        # changed, which changes every result of the loader.
+        base = self.base.compiled
+        if compiled.names != base.names:
+            return None
+        changed = {compiled.stops[i].name for i in np.flatnonzero(affected)}
+        removed = np.setdiff1d(np.arange(len(base)), base_index[base_index >= 0])
+        changed.update(base.stops[i].name for i in removed)
+        new_stops = np.flatnonzero(base_index < 0)
+        touched = {base.stops[i].name for i in removed} | {compiled.stops[i].name for i in new_stops}
+        for name in touched:
+            before = _distances(matrix, base.indices_of(name)).min(axis=1)
+            stops = compiled.indices_of(name)
+            kept_stops = base_index[stops][base_index[stops] >= 0]
+            after = np.full(len(base), np.inf)
+            if len(kept_stops):
+                after = _distances(matrix, kept_stops).min(axis=1)
+            added = np.isin(new_stops, stops)
+            if added.any():
+                after = np.minimum(after, added_times[:, added].min(axis=1))
+            changed.update(base.stops[s].name for s in np.flatnonzero(before != after))
+        return changed
+
+    def _edited_times(self, base: CompiledGraph) -> np.ndarray:
+        times = np.array(base.times, dtype=np.float64)
+        for (line, a, b), minutes in self.segment_times.items():
+            source = base.index_of(Stop(a, 0, None, None, line))
+            target = base.index_of(Stop(b, 0, None, None, line))
+            row = np.asarray(base.indices[base.indptr[source]:base.indptr[source + 1]])
+            times[base.indptr[source] + np.flatnonzero(row == target)[0]] = minutes
+        return times
+
+
+class IncrementalTravelTimes:
+    # times_from() of a scenario graph, like TravelTimeMatrix: the base row and the times to added stops for
+    # origins the edits cannot reach, a search of the scenario graph for the rest
+
+    def __init__(self, compiled: CompiledGraph, base_matrix: TravelTimeMatrix, base_index: np.ndarray,
+                 affected: np.ndarray, added_times: np.ndarray) -> None:
+        self.compiled = compiled
+        self.base_matrix = base_matrix
+        self.transfer_time = base_matrix.transfer_time
+        self.base_index = base_index
+        self.affected = affected
+        self.added_times = added_times  # Scenario.added_stop_times
+        self._kept = np.flatnonzero(base_index >= 0)
+        self._added = np.flatnonzero(base_index < 0)
+
+    def times_from(self, sources: np.ndarray) -> np.ndarray:
+        if self.affected[sources].any():
+            return self.compiled.multi_source_times(sources, transfer_time=self.transfer_time)
+        base_times = self.base_matrix.times_from(self.base_index[sources])
+        times = np.full(len(self.compiled), np.inf)
+        times[self._kept] = base_times[self.base_index[self._kept]]
+        if len(self._added):
+            times[self._added] = self.added_times[self.base_index[sources]].min(axis=0)
+        return times
+
+
+class ScenarioLoader(MPKGraphLoader):
+    # Loader of a Scenario's network, see Scenario.loader()
+
+    def get_times_in_range(self, start_name: str, max_time: float, transfer_time: Optional[float] = None,
+                           departure_time: Optional[int] = None, day_type: str = WEEKDAY) -> np.ndarray:
+        if self._transfer_time is not None:
+            transfer_time = self._transfer_time
+        return super().get_times_in_range(start_name, max_time, transfer_time, departure_time, day_type)
+
+    def result_fingerprint(self, stop_name: str, transfer_time: Optional[float] = None) -> str:
+        # The base fingerprint where the scenario gives the base result, so those cached results stay valid
+        if self._transfer_time is not None and transfer_time != self._transfer_time:
+            return self._fingerprint
+        changed = self._changed_names.get(transfer_time)
+        if changed is not None and stop_name not in changed:
+            return self._base_fingerprint
+        return self._fingerprint
+
+    def changed_names(self, transfer_time: Optional[float] = None) -> Optional[set[str]]:
+        # None when every result may have changed
+        if self._transfer_time is not None and transfer_time != self._transfer_time:
+            return None
+        return self._changed_names.get(transfer_time)
+
+
+def _whole_minutes(times: np.ndarray) -> bool:
+    return bool(np.all(np.mod(times, 1) == 0))
+
+
+def _distances(matrix: TravelTimeMatrix, columns: np.ndarray) -> np.ndarray:
+    # Columns of the base matrix as minutes, np.inf where unreachable
+    times = np.asarray(matrix.times[:, columns], dtype=np.float64)
+    times[times == UNREACHABLE] = np.inf
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply what-if edits to a saved loader and report the stop names '
+                                                 'whose results change.')
+    parser.add_argument('loader', help='path to a *_graph_loader_*.snapshot directory or .pkl file')
+    parser.add_argument('--disable-line', action='append', default=[], metavar='LINE')
+    parser.add_argument('--add-line', action='append', nargs='+', default=[], metavar=('LINE MINUTES', 'STOP'),
+                        help='line through the given stops, MINUTES between every two of them')
+    parser.add_argument('--segment-time', action='append', nargs=4, default=[],
+                        metavar=('LINE', 'FROM', 'TO', 'MINUTES'))
+    parser.add_argument('--transfer-time', type=float, default=None, help='transfer penalty of the scenario')
+    parser.add_argument('--query-transfer-time', type=float, default=5.0)
+    args = parser.parse_args()
+
+    base = MPKGraphLoader.from_path(args.loader)
+    if args.query_transfer_time not in base.attach_travel_matrices(args.loader):
+        print(f'no travel time matrix for transfer time {args.query_transfer_time:g} next to {args.loader}, '
+              f'see python -m load_data.travel_matrix')
+    scenario = Scenario(base)
+    for line in args.disable_line:
+        scenario.disable_line(line)
+    for line, minutes, *names in args.add_line:
+        scenario.add_line(line, names, [float(minutes)] * (len(names) - 1))
+    for line, a, b, minutes in args.segment_time:
+        scenario.set_segment_time(line, a, b, float(minutes))
+    scenario.set_transfer_time(args.transfer_time)
+
+    start = time.perf_counter()
+    loader = scenario.loader()
+    changed = loader.changed_names(args.query_transfer_time)
+    names_count = len(loader.compiled.names)
+    print(f'scenario built in {time.perf_counter() - start:.2f} s, {len(loader.compiled)} stops, '
+          f'{loader.compiled.edges_count} edges')
+    if changed is None:
+        print(f'results of all {names_count} stop names change')
+    else:
+        print(f'results of {len(changed)} of {names_count} stop names change')
+
+
+if __name__ == '__main__':
+    main()
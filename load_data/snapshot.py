@@ -0,0 +1,128 @@
+import argparse
+import json
+import os
+
+from typing import Optional
+
+import networkx as nx
+import numpy as np
+
+from load_data.compiled_graph import EDGE_KINDS, WALK, CompiledGraph
+
+
+FORMAT = 'mpk-network-snapshot'
+VERSION = 2
+
+# Every array is a plain .npy file, so np.load(mmap_mode='r') maps it without copying
+_ARRAYS = (
+    'names', 'lines',
+    'stop_name', 'stop_line', 'stop_code', 'stop_lat', 'stop_lon',
+    'indptr', 'indices', 'times', 'kinds', 'walk_times',
+)
+
+# H3 resolutions whose stop cells are stored as stop_cells_<resolution>.npy (MPKGraphLoader.stop_cells)
+CELL_RESOLUTIONS = (7, 8, 9)
+
+
+def write_snapshot(path: str, loader_class: str, compiled: CompiledGraph, line_names: list[str],
+                   stop_cells: Optional[dict[int, np.ndarray]] = None):
+    names = sorted({stop.name for stop in compiled.stops})
+    name_ids = {name: i for i, name in enumerate(names)}
+    line_names = list(line_names)
+    line_ids = {line: i for i, line in enumerate(line_names)}
+    arrays = {
+        'names': np.array(names, dtype=str),
+        'lines': np.array(line_names, dtype=str),
+        'stop_name': np.array([name_ids[stop.name] for stop in compiled.stops], dtype=np.int32),
+        'stop_line': np.array([line_ids[stop.line] for stop in compiled.stops], dtype=np.int32),
+        'stop_code': np.array([stop.code for stop in compiled.stops], dtype=np.int64),
+        'stop_lat': np.array([np.nan if stop.lat is None else stop.lat for stop in compiled.stops], dtype=np.float64),
+        'stop_lon': np.array([np.nan if stop.lon is None else stop.lon for stop in compiled.stops], dtype=np.float64),
+        'indptr': compiled.indptr.astype(np.int64),
+        'indices': compiled.indices.astype(np.int32),
+        'times': compiled.times.astype(np.float64),
+        'kinds': np.asarray(compiled.kinds, dtype=np.uint8),
+        'walk_times': np.asarray(compiled.walk_times, dtype=np.float64),
+    }
+    for resolution, cells in (stop_cells or {}).items():
+        arrays[f'stop_cells_{resolution}'] = np.asarray(cells, dtype=str)
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f'{name}.npy'), array)
+    meta = {
+        'format': FORMAT,
+        'version': VERSION,
+        'loader': loader_class,
+        'stops': len(compiled),
+        'edges': compiled.edges_count,
+        'lines': len(line_names),
+        'fingerprint': compiled.fingerprint,
+        'cell_resolutions': sorted(stop_cells or {}),
+    }
+    with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as file:
+        json.dump(meta, file, indent=1)
+
+
+def read_snapshot(path: str) -> tuple[dict, dict[str, np.ndarray]]:
+    with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as file:
+        meta = json.load(file)
+    if meta.get('format') != FORMAT or meta.get('version') not in (1, VERSION):
+        raise ValueError(f'{path} is not a version {VERSION} network snapshot: {meta.get("format")} '
+                         f'version {meta.get("version")}.')
+    # Version 1 flagged line changes in `transfers`, all of them transfers at one stop
+    names = _ARRAYS if meta['version'] == VERSION else _ARRAYS[:-2] + ('transfers',)
+    # Stop cells are optional; older snapshots compute them on first use
+    names += tuple(f'stop_cells_{resolution}' for resolution in meta.get('cell_resolutions', []))
+    arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in names}
+    if 'transfers' in arrays:
+        arrays['kinds'] = np.asarray(arrays.pop('transfers')).view(np.uint8)
+        arrays['walk_times'] = np.zeros(len(arrays['indices']))
+    return meta, arrays
+
+
+def compiled_from_arrays(arrays: dict[str, np.ndarray], stop_class) -> CompiledGraph:
+    names = arrays['names'].tolist()
+    lines = arrays['lines'].tolist()
+    stops = [
+        stop_class(names[name], code, None if np.isnan(lat) else lat, None if np.isnan(lon) else lon, lines[line])
+        for name, line, code, lat, lon in zip(
+            arrays['stop_name'].tolist(), arrays['stop_line'].tolist(), arrays['stop_code'].tolist(),
+            arrays['stop_lat'].tolist(), arrays['stop_lon'].tolist()
+        )
+    ]
+    return CompiledGraph(stops, arrays['indptr'], arrays['indices'], arrays['times'], arrays['kinds'],
+                         arrays['walk_times'])
+
+
+def graph_from_compiled(compiled: CompiledGraph) -> nx.DiGraph:
+    graph = nx.DiGraph()
+    graph.add_nodes_from(compiled.stops)
+    stops = compiled.stops
+    indptr, indices = compiled.indptr.tolist(), compiled.indices.tolist()
+    times, kinds, walk_times = compiled.times.tolist(), compiled.kinds.tolist(), compiled.walk_times.tolist()
+    for u, stop in enumerate(stops):
+        for k in range(indptr[u], indptr[u + 1]):
+            # Run times come from the XML as whole minutes; transfer times keep the configured float
+            time = times[k] if kinds[k] or not times[k].is_integer() else int(times[k])
+            if kinds[k] == WALK:
+                graph.add_edge(stop, stops[indices[k]], time=time, kind=EDGE_KINDS[kinds[k]], walk=walk_times[k])
+            else:
+                graph.add_edge(stop, stops[indices[k]], time=time, kind=EDGE_KINDS[kinds[k]])
+    return graph
+
+
+def main():
+    from load_data.load_data import MPKGraphLoader
+
+    parser = argparse.ArgumentParser(description='Convert pickled graph loaders into network snapshots.')
+    parser.add_argument('loaders', nargs='+', help='paths to *_graph_loader_*.pkl files')
+    args = parser.parse_args()
+    for loader_path in args.loaders:
+        loader = MPKGraphLoader.from_pickle(loader_path)
+        path = f'{os.path.splitext(loader_path)[0]}.snapshot'
+        loader.to_snapshot(path)
+        print(f'{path}: {len(loader.compiled)} stops, {loader.compiled.edges_count} edges')
+
+
+if __name__ == '__main__':
+    main()
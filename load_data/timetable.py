@@ -0,0 +1,150 @@
+import os
+
+from typing import Iterable, Optional
+
+import numpy as np
+
+from load_data.compiled_graph import RIDE, CompiledGraph
+from load_data.ingest import ParsedLine, get_line_paths, ingest_lines
+
+
+WEEKDAY = 'w dni robocze'
+SATURDAY = 'sobota'
+SUNDAY = 'niedziela'
+
+_COLUMNS = ('dep', 'arr', 'from', 'to', 'trip')
+
+
+class Timetable:
+    # Per day type, departures packed as connections sorted by departure time;
+    # stop indices follow the compiled graph the timetable was built for
+
+    def __init__(self, compiled: CompiledGraph, connections: dict[str, dict[str, np.ndarray]], trips_count: int) -> None:
+        self.compiled = compiled
+        self.connections = connections
+        self.trips_count = trips_count
+        # Transfers and walks leaving every stop: target, build-time weight and walking minutes
+        self._transfers: list[list[tuple[int, float, float]]] = [[] for _ in range(len(compiled))]
+        transfers = compiled.transfers
+        for u in range(len(compiled)):
+            for k in range(compiled.indptr[u], compiled.indptr[u + 1]):
+                if transfers[k]:
+                    self._transfers[u].append((int(compiled.indices[k]), float(compiled.times[k]),
+                                               float(compiled.walk_times[k])))
+
+    @property
+    def day_types(self) -> list[str]:
+        return list(self.connections.keys())
+
+    @staticmethod
+    def from_lines(lines: list[ParsedLine], compiled: CompiledGraph) -> "Timetable":
+        index = {(stop.name, stop.line): i for i, stop in enumerate(compiled.stops)}
+        rides = np.asarray(compiled.kinds) == RIDE
+        edge_sources = np.repeat(np.arange(len(compiled)), np.diff(compiled.indptr))
+        edges = set(zip(edge_sources[rides].tolist(), np.asarray(compiled.indices)[rides].tolist()))
+        # (dep, arr, trip, hop, from, to): equal times keep the hop order of a trip, so a zero-minute hop is
+        # scanned before the next hop leaves the stop it arrives at
+        rows: dict[str, list[tuple[int, int, int, int, int, int]]] = {}
+        trips_count = 0
+        for parsed in lines:
+            line_name = parsed.name.lower()
+            for variant in (parsed.timetables or {}).values():
+                # (day, minute a vehicle reaches this stop) -> trips, so consecutive hops chain into one trip
+                pending: dict[tuple[str, int], list[int]] = {}
+                for hop, stop in enumerate(variant):
+                    if stop.next_name is None:
+                        pending = {}
+                        continue
+                    u = index.get((stop.name.lower(), line_name))
+                    v = index.get((stop.next_name.lower(), line_name))
+                    next_pending: dict[tuple[str, int], list[int]] = {}
+                    for day, departures in stop.departures.items():
+                        for departure in departures:
+                            waiting = pending.get((day, departure))
+                            if waiting:
+                                trip = waiting.pop()
+                            else:
+                                trip = trips_count
+                                trips_count += 1
+                            arrival = departure + stop.run_time
+                            next_pending.setdefault((day, arrival), []).append(trip)
+                            # Every variant runs trips, depot runs included, but only hops along a ride
+                            # edge of the graph become connections
+                            if (u, v) in edges:
+                                rows.setdefault(day, []).append((departure, arrival, trip, hop, u, v))
+                    pending = next_pending
+
+        connections = {}
+        for day, day_rows in rows.items():
+            day_rows.sort()
+            packed = np.array(day_rows, dtype=np.int32).reshape(-1, 6)
+            connections[day] = {
+                column: np.ascontiguousarray(packed[:, i])
+                for column, i in zip(_COLUMNS, (0, 1, 4, 5, 2))
+            }
+        return Timetable(compiled, connections, trips_count)
+
+    @staticmethod
+    def from_data(data_path: str, compiled: CompiledGraph, processes: Optional[int] = None,
+                  cache_dir: Optional[str] = None) -> "Timetable":
+        ingested = ingest_lines(get_line_paths(data_path), processes=processes, timetables=True, cache_dir=cache_dir)
+        return Timetable.from_lines(ingested.lines, compiled)
+
+    @staticmethod
+    def path_for(loader_path: str, compiled: CompiledGraph) -> str:
+        base, _ = os.path.splitext(loader_path)
+        return f'{base}.timetable.{compiled.fingerprint}.npz'
+
+    @staticmethod
+    def find(loader_path: str, compiled: CompiledGraph) -> Optional["Timetable"]:
+        path = Timetable.path_for(loader_path, compiled)
+        if not os.path.exists(path):
+            return None
+        return Timetable.load(path, compiled)
+
+    def save(self, path: str):
+        arrays = {'days': np.array(self.day_types), 'trips_count': np.array(self.trips_count)}
+        for i, day in enumerate(self.day_types):
+            for column in _COLUMNS:
+                arrays[f'day{i}_{column}'] = self.connections[day][column]
+        np.savez(path, **arrays)
+
+    @staticmethod
+    def load(path: str, compiled: CompiledGraph) -> "Timetable":
+        with np.load(path) as data:
+            connections = {
+                str(day): {column: data[f'day{i}_{column}'] for column in _COLUMNS}
+                for i, day in enumerate(data['days'])
+            }
+            return Timetable(compiled, connections, int(data['trips_count']))
+
+    def earliest_arrival(self, sources: Iterable[int], departure_time: int, day_type: str = WEEKDAY,
+                         max_time: float = np.inf, transfer_time: Optional[float] = None) -> np.ndarray:
+        # Connection Scan over the departures between departure_time and departure_time + max_time;
+        # returns minutes elapsed since departure_time, np.inf where a stop is not reached
+        if day_type not in self.connections:
+            raise ValueError(f'Unknown day type "{day_type}". Available: {self.day_types}')
+        connections = self.connections[day_type]
+        end_time = departure_time + max_time
+        lo = int(np.searchsorted(connections['dep'], departure_time, side='left'))
+        hi = int(np.searchsorted(connections['dep'], end_time, side='right')) if np.isfinite(end_time) else len(connections['dep'])
+
+        arrival = [np.inf] * len(self.compiled)
+        for source in sources:
+            arrival[source] = departure_time
+        boarded = bytearray(self.trips_count)
+        transfers = self._transfers
+
+        for dep, arr, u, v, trip in zip(*(connections[column][lo:hi].tolist() for column in _COLUMNS)):
+            if not boarded[trip]:
+                if arrival[u] > dep:
+                    continue
+                boarded[trip] = 1
+            if arr < arrival[v] and arr <= end_time:
+                arrival[v] = arr
+                for w, baked_time, walk_time in transfers[v]:
+                    w_arrival = arr + (baked_time if transfer_time is None else transfer_time + walk_time)
+                    if w_arrival < arrival[w]:
+                        arrival[w] = w_arrival
+
+        return np.array(arrival, dtype=np.float64) - departure_time
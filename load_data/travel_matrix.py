@@ -0,0 +1,123 @@
+import argparse
+import glob
+import os
+import re
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from load_data.compiled_graph import CompiledGraph
+
+
+UNREACHABLE = np.iinfo(np.uint16).max
+CHUNK_SIZE = 128
+
+_worker_matrix: Optional[csr_matrix] = None
+
+
+class TravelTimeMatrix:
+    # Stop-to-stop minimum travel times in whole minutes (rounded up), rows and columns in compiled stop order
+
+    def __init__(self, times: np.ndarray, transfer_time: float) -> None:
+        self.times = times
+        self.transfer_time = transfer_time
+
+    def __len__(self) -> int:
+        return self.times.shape[0]
+
+    @staticmethod
+    def compute(compiled: CompiledGraph, transfer_time: float, processes: Optional[int] = None) -> "TravelTimeMatrix":
+        matrix = compiled.matrix(transfer_time)
+        chunks = [np.arange(i, min(i + CHUNK_SIZE, len(compiled))) for i in range(0, len(compiled), CHUNK_SIZE)]
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(matrix,)) as executor:
+            rows = list(executor.map(_compute_rows, chunks))
+        return TravelTimeMatrix(np.concatenate(rows), transfer_time)
+
+    @staticmethod
+    def path_for(loader_path: str, compiled: CompiledGraph, transfer_time: float) -> str:
+        # The fingerprint ties the artifact to one exact graph, so a stale matrix is never picked up
+        base, _ = os.path.splitext(loader_path)
+        return f'{base}.tt{transfer_time:g}.{compiled.fingerprint}.npy'
+
+    @staticmethod
+    def find(loader_path: str, compiled: CompiledGraph) -> list["TravelTimeMatrix"]:
+        base, _ = os.path.splitext(loader_path)
+        ret = []
+        for path in sorted(glob.glob(f'{glob.escape(base)}.tt*.{compiled.fingerprint}.npy')):
+            match = re.search(r'\.tt([0-9.]+)\.[0-9a-f]+\.npy$', path)
+            if match is not None:
+                ret.append(TravelTimeMatrix.load(path, float(match.group(1)), compiled))
+        return ret
+
+    def save(self, path: str):
+        np.save(path, self.times)
+
+    @staticmethod
+    def load(path: str, transfer_time: float, compiled: Optional[CompiledGraph] = None) -> "TravelTimeMatrix":
+        times = np.load(path, mmap_mode='r')
+        if compiled is not None and times.shape != (len(compiled), len(compiled)):
+            raise ValueError(f'Travel time matrix {path} has shape {times.shape}, expected {len(compiled)} stops.')
+        return TravelTimeMatrix(times, transfer_time)
+
+    def times_from(self, sources: np.ndarray) -> np.ndarray:
+        times = self.times[sources].min(axis=0).astype(np.float64)
+        times[times == UNREACHABLE] = np.inf
+        return times
+
+    def average_shortest_path(self) -> float:
+        reachable = self.__reachable_pairs()
+        return float(self.times[reachable].mean())
+
+    def diameter(self) -> int:
+        reachable = self.__reachable_pairs()
+        return int(self.times[reachable].max())
+
+    def coverage(self, max_time: float) -> np.ndarray:
+        # Number of stops reachable within max_time from every stop (itself included)
+        return (self.times <= max_time).sum(axis=1)
+
+    def __reachable_pairs(self) -> np.ndarray:
+        reachable = self.times != UNREACHABLE
+        np.fill_diagonal(reachable, False)
+        return reachable
+
+
+def _init_worker(matrix: csr_matrix):
+    global _worker_matrix
+    _worker_matrix = matrix
+
+
+def _compute_rows(sources: np.ndarray) -> np.ndarray:
+    times = dijkstra(_worker_matrix, directed=True, indices=sources)
+    rows = np.full(times.shape, UNREACHABLE, dtype=np.uint16)
+    reachable = np.isfinite(times)
+    rows[reachable] = np.minimum(np.ceil(times[reachable]), UNREACHABLE - 1)
+    return rows
+
+
+def main():
+    from load_data.load_data import MPKGraphLoader
+
+    parser = argparse.ArgumentParser(description='Precompute stop-to-stop travel time matrices for saved loaders.')
+    parser.add_argument('loaders', nargs='+', help='paths to *_graph_loader_*.snapshot directories or .pkl files')
+    parser.add_argument('--transfer-times', nargs='+', type=float, default=[5.0])
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, all cores by default')
+    args = parser.parse_args()
+
+    for loader_path in args.loaders:
+        loader = MPKGraphLoader.from_path(loader_path)
+        for transfer_time in args.transfer_times:
+            matrix = TravelTimeMatrix.compute(loader.compiled, transfer_time, args.processes)
+            path = TravelTimeMatrix.path_for(loader_path, loader.compiled, transfer_time)
+            matrix.save(path)
+            print(f'{path}: {len(matrix)} stops, diameter {matrix.diameter()}, '
+                  f'avg shortest path {matrix.average_shortest_path():.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+from typing import Callable, Optional
+
+import folium
+
+import metrics
+import ui_config as cfg
+from load_data.load_data import MPKGraphLoader
+from load_data.scenario import Scenario
+from load_data.timetable import WEEKDAY
+from map_utils import get_izochrone_map, TransferConfig, get_map, get_izochrone_data, get_map_data, \
+    get_stops_version
+from result_cache import ResultCache
+from warm_up import WarmResults
+
+# Everything a map computation needs, without the web application: the server opens every loader up front,
+# map worker processes import only this module and open a loader the first time one of its maps is requested.
+
+LOADER_PATHS = cfg.LOADER_PATHS
+
+LOADERS: dict[str, MPKGraphLoader] = {}
+BASE_LOADERS: dict[str, MPKGraphLoader] = {}
+WARM_RESULTS: dict[str, Optional[WarmResults]] = {}
+
+# What-if scenarios (load_data.scenario.Scenario.to_dict()) served in place of the base network
+ACTIVE_SCENARIOS: dict[str, dict] = {}
+
+# Held while a loader is opened or swapped, so a map reads its loader and warm results of the same network
+_LOCK = threading.RLock()
+
+# Rendered maps and map data, shared by all worker processes
+RESULT_CACHE = ResultCache(cfg.RESULT_CACHE_PATH, cfg.RESULT_CACHE_MAX_BYTES, cfg.RESULT_CACHE_LOCK_TIMEOUT)
+
+
+def open_loader(loader_name: str) -> MPKGraphLoader:
+    path = LOADER_PATHS[loader_name]
+    # Snapshots (python -m load_data.snapshot) are memory-mapped, so workers share the edge arrays
+    loader = MPKGraphLoader.from_snapshot(path)
+    # Precomputed travel time matrices (python -m load_data.travel_matrix) turn reachability into a row lookup
+    loader.attach_travel_matrices(path)
+    # Packed departures (python -m load_data.build --timetables) enable isochrones for a given departure time
+    loader.attach_timetable(path)
+    BASE_LOADERS[loader_name] = loader
+    serve_scenario(loader_name, ACTIVE_SCENARIOS.get(loader_name))
+    return loader
+
+
+def serve_scenario(loader_name: str, scenario: Optional[dict]) -> MPKGraphLoader:
+    base = BASE_LOADERS[loader_name]
+    if scenario is None:
+        loader = base
+        # Bands and coverage of every stop for the default parameters (python -m warm_up) answer by lookup
+        warm = WarmResults.find(LOADER_PATHS[loader_name], base.compiled)
+    else:
+        loader = Scenario.from_dict(base, scenario).loader()
+        warm = None
+    with _LOCK:
+        if scenario is None:
+            ACTIVE_SCENARIOS.pop(loader_name, None)
+        else:
+            ACTIVE_SCENARIOS[loader_name] = scenario
+        LOADERS[loader_name] = loader
+        WARM_RESULTS[loader_name] = warm
+    return loader
+
+
+def active_scenarios() -> dict[str, dict]:
+    with _LOCK:
+        return dict(ACTIVE_SCENARIOS)
+
+
+# In a map worker process: its slot in the arrays shared with the server, which hold the pid of every worker and
+# the task it is running (0 for none), so the server can stop the worker of a timed-out page alone
+_SLOT: Optional[int] = None
+_SLOT_TASKS = None
+
+
+def init_worker(scenarios: dict[str, dict], pids=None, tasks=None):
+    global _SLOT, _SLOT_TASKS
+    ACTIVE_SCENARIOS.update(scenarios)
+    if pids is None:
+        return
+    with pids.get_lock():
+        # The server frees the slot of a worker it stops; a worker that finds none runs untracked
+        free = [slot for slot, pid in enumerate(pids) if pid == 0]
+        if free:
+            _SLOT = free[0]
+            pids[_SLOT] = os.getpid()
+    _SLOT_TASKS = tasks
+
+
+def run_task(task_id: int, function: Callable, *args) -> tuple[object, list[tuple[str, float]]]:
+    if _SLOT is not None:
+        _SLOT_TASKS[_SLOT] = task_id
+    try:
+        return metrics.call_collecting(function, *args)
+    finally:
+        if _SLOT is not None:
+            _SLOT_TASKS[_SLOT] = 0
+
+
+def _network(loader_name: str) -> tuple[MPKGraphLoader, Optional[WarmResults]]:
+    # Read once per map; the result key and the computation both use this loader
+    with _LOCK:
+        if loader_name not in LOADERS:
+            open_loader(loader_name)
+        return LOADERS[loader_name], WARM_RESULTS[loader_name]
+
+
+def compute_isochrone_map(stop_name: str, transfer_time_minutes: int, loader_name: str,
+                          departure_time: Optional[int] = None, day_type: str = WEEKDAY) -> str:
+    loader, warm = _network(loader_name)
+    transfer_cfg = TransferConfig(stop_name, 5, transfer_time_minutes, departure_time, day_type)
+    cell_bands = warm.cell_bands(loader, cfg.DEFAULT_REGIONS_RESOLUTION, transfer_cfg,
+                                 cfg.DEFAULT_STOP_REACH_MAX_TIME_LIST) if warm is not None else None
+    metrics.count('warm_results', 'miss' if cell_bands is None else 'hit')
+
+    key = _result_key(loader, 'iso_map', loader_name, stop_name, None, transfer_time_minutes, departure_time,
+                      day_type)
+    return RESULT_CACHE.get_or_compute(key, lambda: _render(get_izochrone_map(
+        cfg.DEFAULT_REGIONS_RESOLUTION, loader, transfer_cfg, cfg.DEFAULT_STOP_REACH_MAX_TIME_LIST,
+        cell_bands=cell_bands
+    )))
+
+
+def compute_default_map(stop_name: str, stop_reach_max_time: int, transfer_time_minutes: int, loader_name: str) -> str:
+    loader, warm = _network(loader_name)
+    transfer_cfg = TransferConfig(stop_name, stop_reach_max_time, transfer_time_minutes)
+    coverage = warm.coverage(loader, cfg.DEFAULT_REGIONS_RESOLUTION, transfer_cfg) if warm is not None else None
+    metrics.count('warm_results', 'miss' if coverage is None else 'hit')
+
+    key = _result_key(loader, 'default_map', loader_name, stop_name, stop_reach_max_time, transfer_time_minutes)
+    return RESULT_CACHE.get_or_compute(key, lambda: _render(get_map(
+        cfg.DEFAULT_REGIONS_RESOLUTION, loader, transfer_cfg, coverage
+    )))
+
+
+def compute_isochrone_data(stop_name: str, transfer_time_minutes: int, loader_name: str,
+                           departure_time: Optional[int] = None, day_type: str = WEEKDAY) -> str:
+    loader, warm = _network(loader_name)
+    transfer_cfg = TransferConfig(stop_name, 5, transfer_time_minutes, departure_time, day_type)
+    data = warm.isochrone_data(loader, cfg.DEFAULT_REGIONS_RESOLUTION, transfer_cfg,
+                               cfg.DEFAULT_STOP_REACH_MAX_TIME_LIST) if warm is not None else None
+    metrics.count('warm_results', 'miss' if data is None else 'hit')
+    if data is not None:
+        return json.dumps({'map_type': 'iso', 'loader': loader_name, 'stops': _stops_url(loader, loader_name),
+                           **data})
+
+    key = _result_key(loader, 'iso', loader_name, stop_name, None, transfer_time_minutes, departure_time, day_type)
+    return RESULT_CACHE.get_or_compute(key, lambda: json.dumps({
+        'map_type': 'iso', 'loader': loader_name, 'stops': _stops_url(loader, loader_name),
+        **get_izochrone_data(cfg.DEFAULT_REGIONS_RESOLUTION, loader, transfer_cfg, cfg.DEFAULT_STOP_REACH_MAX_TIME_LIST)
+    }))
+
+
+def compute_default_data(stop_name: str, stop_reach_max_time: int, transfer_time_minutes: int, loader_name: str) -> str:
+    loader, warm = _network(loader_name)
+    transfer_cfg = TransferConfig(stop_name, stop_reach_max_time, transfer_time_minutes)
+    data = warm.map_data(loader, cfg.DEFAULT_REGIONS_RESOLUTION, transfer_cfg) if warm is not None else None
+    metrics.count('warm_results', 'miss' if data is None else 'hit')
+    if data is not None:
+        return json.dumps({'map_type': 'default', 'loader': loader_name, 'stops': _stops_url(loader, loader_name),
+                           **data})
+
+    key = _result_key(loader, 'default', loader_name, stop_name, stop_reach_max_time, transfer_time_minutes)
+    return RESULT_CACHE.get_or_compute(key, lambda: json.dumps({
+        'map_type': 'default', 'loader': loader_name, 'stops': _stops_url(loader, loader_name),
+        **get_map_data(cfg.DEFAULT_REGIONS_RESOLUTION, loader, transfer_cfg)
+    }))
+
+
+def _stops_url(loader: MPKGraphLoader, loader_name: str) -> str:
+    # The stop list the ids of this answer index; a scenario that changes the names changes the URL
+    return f'/stops/{loader_name}?v={get_stops_version(loader)}'
+
+
+def _render(map_: folium.Map) -> str:
+    with metrics.stage('render'):
+        return map_._repr_html_()
+
+
+def _result_key(loader: MPKGraphLoader, map_type: str, loader_name: str, stop_name: str, max_time: Optional[int],
+                transfer_time: int, departure_time: Optional[int] = None, day_type: Optional[str] = None) -> str:
+    # The graph fingerprint keeps entries computed for an older build of the loader, or for a scenario that
+    # changes this result, from being served
+    fingerprint = loader.result_fingerprint(stop_name, transfer_time)
+    return json.dumps([map_type, loader_name, fingerprint, stop_name, max_time, transfer_time,
+                       departure_time, day_type, cfg.DEFAULT_REGIONS_RESOLUTION], ensure_ascii=False)
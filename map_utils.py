@@ -1,41 +1,65 @@
+import hashlib
+import json
 from functools import lru_cache
 
 from folium import folium
-from srai.regionalizers import geocode_to_region_gdf, H3Regionalizer
+from folium.features import GeoJson
+from folium.plugins import HeatMap
 from load_data.load_data import MPKGraphLoader
+from load_data.timetable import WEEKDAY
 from shapely.geometry import Point
 from matplotlib.colors import LinearSegmentedColormap
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import matplotlib.colors as clr
 import matplotlib.pyplot as plt
 
-CITY = "Wroclaw"
-COUNTRY = "Poland"
+from metrics import stage
+from region_store import get_region_store
+
+UNREACHED_COLOR = '#a9a9a9'
 
 
 class TransferConfig:
-    def __init__(self, start_name, max_time, transfer_time):
+    def __init__(self, start_name, max_time, transfer_time, departure_time=None, day_type=WEEKDAY):
         self.start_name = start_name
         self.max_time = max_time
         self.transfer_time = transfer_time
+        # Minutes after midnight; when set, the search follows the timetable instead of static run times
+        self.departure_time = departure_time
+        self.day_type = day_type
 
 
-def get_map(regions_resolution: int, graph_loader: MPKGraphLoader, transfer_cfg: TransferConfig = None):
+def get_map(regions_resolution: int, graph_loader: MPKGraphLoader, transfer_cfg: TransferConfig = None,
+            coverage: tuple[np.ndarray, np.ndarray] = None):
+    # coverage: cell shares and reached stop names found beforehand (warm_up.WarmResults.coverage), skips the search
     if regions_resolution <= 1:
         raise ValueError(f"Regions resolution must be greater than 1. Currently {regions_resolution}")
 
-    stops = _load_stops(graph_loader)
-    regions = _get_regions(regions_resolution, graph_loader, transfer_cfg)
+    with stage('stops'):
+        stops = _load_stops(graph_loader)
+    if coverage is None:
+        regions = _get_regions(regions_resolution, graph_loader, transfer_cfg)
+    else:
+        with stage('regions'):
+            regions = get_region_store().regions(regions_resolution)
+        regions['count'] = coverage[0]
 
-    map_ = regions.explore(tooltip=False, highlight=False, column="count", cmap='Blues', style_kwds=dict(opacity=0.05))
-    map_ = stops.explore(color="#ff7daf", m=map_, style_kwds=dict(opacity=0.8))
+    with stage('explore'):
+        map_ = regions.explore(tooltip=False, highlight=False, column="count", cmap='Blues',
+                               style_kwds=dict(opacity=0.05))
+        map_ = stops.explore(color="#ff7daf", m=map_, style_kwds=dict(opacity=0.8))
 
     if transfer_cfg:
-        stops_in_range = _find_stops_in_range(graph_loader, transfer_cfg)
-        map_ = stops_in_range.explore(color="#1eff00", m=map_)
-        starting_stop = _get_starting_stop(graph_loader, transfer_cfg)
-        map_ = starting_stop.explore(color="#ff0000", m=map_)
+        if coverage is None:
+            stops_in_range = _find_stops_in_range(graph_loader, transfer_cfg)
+        else:
+            stops_in_range = _get_named_stops(graph_loader, np.flatnonzero(coverage[1]))
+        with stage('explore'):
+            map_ = stops_in_range.explore(color="#1eff00", m=map_)
+            starting_stop = _get_starting_stop(graph_loader, transfer_cfg)
+            map_ = starting_stop.explore(color="#ff0000", m=map_)
 
     return map_
 
@@ -51,38 +75,120 @@ def get_hex_area(regions_resolution: int, graph_loader: MPKGraphLoader, transfer
 
 
 def get_izochrone_map(regions_resolution: int, graph_loader: MPKGraphLoader, transfer_cfg: TransferConfig,
-                      max_times: list[int], zoom_start: int = 12):
+                      max_times: list[int], zoom_start: int = 12, cell_bands: np.ndarray = None):
+    # cell_bands: bands found beforehand (warm_up.WarmResults.cell_bands), skips the search
     if regions_resolution <= 1:
         raise ValueError(f"Regions resolution must be greater than 1. Currently {regions_resolution}")
 
     max_times = sorted(max_times, reverse=False)
-    regions = _get_regions(regions_resolution, graph_loader, transfer_cfg)
+    with stage('regions'):
+        regions = get_region_store().regions(regions_resolution)
+        grid_features = get_region_store().geojson(regions_resolution)['features']
     t_min, t_max = min(max_times), max(max_times)
     colors = _get_colors_from_cmap(max_times, vmin=t_min, vmax=t_max)
+    if cell_bands is None:
+        cell_bands = _get_cell_bands(regions_resolution, graph_loader, transfer_cfg, max_times, regions)
+    band_colors = np.array(colors + [UNREACHED_COLOR])
+
+    with stage('layer'):
+        # A single layer over the cached grid features, each carrying only its color
+        features = [
+            {**feature, 'properties': {'color': color}}
+            for feature, color in zip(grid_features, band_colors[cell_bands].tolist())
+        ]
+        x_min, y_min, x_max, y_max = regions.geometry[cell_bands == cell_bands.min()].total_bounds
+        map_ = folium.Map(location=((y_min + y_max) / 2, (x_min + x_max) / 2), zoom_start=zoom_start,
+                          control_scale=True)
+        GeoJson({'type': 'FeatureCollection', 'features': features}, style_function=_get_band_style).add_to(map_)
+
+    with stage('explore'):
+        starting_stop = _get_starting_stop(graph_loader, transfer_cfg)
+        map_ = starting_stop.explore(color="#ff0000", m=map_)
+    return map_
+
 
-    map_ = None
-
-    already_collored = set()
-    for time, color in zip(max_times, colors):
-        stops_in_rage = _find_stops_in_range(graph_loader, transfer_cfg=TransferConfig(transfer_cfg.start_name, time,
-                                                                                       transfer_cfg.transfer_time))
-        joined_data: gpd.GeoDataFrame = gpd.sjoin(regions, stops_in_rage)
-        not_collored_data: gpd.GeoDataFrame = joined_data[~joined_data['geometry'].isin(already_collored)]
-        not_collored_data = gpd.GeoDataFrame(not_collored_data['geometry']).drop_duplicates()
-        already_collored.update(not_collored_data['geometry'])
-        map_ = not_collored_data.explore(color=color, m=map_, tooltip=False, highlight=False,
-                                         style_kwds=dict(opacity=0.05, fillOpacity=0.8),
-                                         zoom_start=zoom_start)
-
-    unused_hexes = gpd.GeoDataFrame(regions['geometry'])
-    unused_hexes = unused_hexes[~unused_hexes['geometry'].isin(already_collored)]
-    map_ = unused_hexes.explore(color='#a9a9a9', m=map_, highlight=False, tooltip=False)
-
-    starting_stop = _get_starting_stop(graph_loader, transfer_cfg)
-    map_ = starting_stop.explore(color="#ff0000", m=map_)
+def get_izochrone_data(regions_resolution: int, graph_loader: MPKGraphLoader, transfer_cfg: TransferConfig,
+                       max_times: list[int]) -> dict:
+    # What get_izochrone_map draws, without the geometry: band of every reached cell and the starting stop
+    if regions_resolution <= 1:
+        raise ValueError(f"Regions resolution must be greater than 1. Currently {regions_resolution}")
+
+    max_times = sorted(max_times, reverse=False)
+    with stage('regions'):
+        regions = get_region_store().regions(regions_resolution)
+    cell_bands = _get_cell_bands(regions_resolution, graph_loader, transfer_cfg, max_times, regions)
+    reached_cells = np.flatnonzero(cell_bands < len(max_times))
+
+    return {
+        'resolution': regions_resolution,
+        'max_times': max_times,
+        'colors': _get_colors_from_cmap(max_times, vmin=min(max_times), vmax=max(max_times)),
+        'cells': regions.index[reached_cells].tolist(),
+        'bands': cell_bands[reached_cells].tolist(),
+        'start_stops': _get_start_ids(graph_loader, transfer_cfg),
+    }
+
+
+def get_map_data(regions_resolution: int, graph_loader: MPKGraphLoader, transfer_cfg: TransferConfig) -> dict:
+    # What get_map draws, without the geometry: reached share of stops per cell and the reached stop ids,
+    # which index get_stops_data(graph_loader)
+    if regions_resolution <= 1:
+        raise ValueError(f"Regions resolution must be greater than 1. Currently {regions_resolution}")
+
+    with stage('regions'):
+        regions = get_region_store().regions(regions_resolution)
+    name_cells = _get_name_cells(regions_resolution, graph_loader, regions)
+    name_times = graph_loader.compiled.name_times(_find_times_in_range(graph_loader, transfer_cfg))
+    values = _get_cell_counts(name_cells, len(regions), name_times, transfer_cfg.max_time)
+    filled_cells = np.flatnonzero(values)
+
+    return {
+        'resolution': regions_resolution,
+        'cells': regions.index[filled_cells].tolist(),
+        'values': np.round(values[filled_cells], 4).tolist(),
+        'reached_stops': np.flatnonzero(name_times <= transfer_cfg.max_time).tolist(),
+        'start_stops': _get_start_ids(graph_loader, transfer_cfg),
+    }
+
+
+def get_stops_data(graph_loader: MPKGraphLoader) -> dict:
+    # Stop names of the compiled graph with [lat, lon] (None when unknown); ids used by the *_data functions
+    compiled = graph_loader.compiled
+    heads = [compiled.stops[i] for i in compiled.name_heads]
+    return {
+        'names': compiled.names,
+        'coordinates': [None if pd.isna(stop.lat) or pd.isna(stop.lon) else [stop.lat, stop.lon] for stop in heads],
+    }
+
+
+@lru_cache(maxsize=32)
+def get_stops_version(graph_loader: MPKGraphLoader) -> str:
+    # Changes with the stop names and their coordinates, so a /stops URL carrying it can be cached by browsers
+    data = json.dumps(get_stops_data(graph_loader), ensure_ascii=False)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:12]
+
+
+def get_coverage_map(coverage: gpd.GeoDataFrame, column: str = 'coverage_ratio', zoom_start: int = 12):
+    # Heat layer of a per-stop coverage frame (stop_coverage.compute_coverage), weighted by `column`
+    located = coverage[coverage.geometry.notna() & ~coverage.geometry.is_empty]
+    located = located[np.isfinite(located.geometry.x) & np.isfinite(located.geometry.y)]
+    values = located[column].to_numpy(dtype=float)
+    weights = values / values.max() if len(values) and values.max() > 0 else values
+    x_min, y_min, x_max, y_max = located.total_bounds
+    map_ = folium.Map(location=((y_min + y_max) / 2, (x_min + x_max) / 2), zoom_start=zoom_start,
+                      control_scale=True)
+    HeatMap(np.column_stack([located.geometry.y, located.geometry.x, weights]).tolist(),
+            name=column, radius=20).add_to(map_)
     return map_
 
 
+def _get_band_style(feature: dict) -> dict:
+    color = feature['properties']['color']
+    if color == UNREACHED_COLOR:
+        return {'color': color, 'fillColor': color, 'weight': 2, 'fillOpacity': 0.5}
+    return {'color': color, 'fillColor': color, 'weight': 2, 'opacity': 0.05, 'fillOpacity': 0.8}
+
+
 def _get_colors_from_cmap(data, vmin, vmax):
     cmap = clr.LinearSegmentedColormap.from_list('green to red', ['#7ddf64', '#ffc25e', '#e05263'], N=256)
     norm = plt.Normalize(vmin=vmin, vmax=vmax)
@@ -93,29 +199,61 @@ def _get_colors_from_cmap(data, vmin, vmax):
 
 def _get_regions(regions_resolution: int, graph_loader: MPKGraphLoader,
                  transfer_cfg: TransferConfig) -> gpd.GeoDataFrame:
-    area_name = f"{CITY}, {COUNTRY}"
-    area = geocode_to_region_gdf(area_name)
-    regions = H3Regionalizer(regions_resolution).transform(area)
-
-    all_stops = _load_stops(graph_loader)
-    all_stops_region = gpd.sjoin(all_stops, regions, how='left', op='within')
-
-    no_stops_per_region = all_stops_region.index_right.value_counts().astype(int)
+    with stage('regions'):
+        regions = get_region_store().regions(regions_resolution)
+    name_cells = _get_name_cells(regions_resolution, graph_loader, regions)
 
     if transfer_cfg:
-        stops = _find_stops_in_range(graph_loader, transfer_cfg)
-        stops_region = pd.merge(stops, all_stops_region, how='left', on='region_id')
-        visited_stops_per_region = stops_region.index_right.value_counts().astype(int)
-        no_stops_per_region = (visited_stops_per_region / no_stops_per_region).fillna(0)
-
-    regions = pd.concat([
-        regions,
-        no_stops_per_region
-    ], axis=1).fillna(0)
+        name_times = graph_loader.compiled.name_times(_find_times_in_range(graph_loader, transfer_cfg))
+        regions['count'] = _get_cell_counts(name_cells, len(regions), name_times, transfer_cfg.max_time)
+    else:
+        regions['count'] = _get_cell_counts(name_cells, len(regions))
 
     return regions
 
 
+def _get_cell_counts(name_cells: np.ndarray, regions_count: int, name_times: np.ndarray = None,
+                     max_time: float = None) -> np.ndarray:
+    # Stop names per cell, each counted once; with name_times, the share of them reached within max_time
+    in_grid = name_cells >= 0
+    no_stops_per_region = np.bincount(name_cells[in_grid], minlength=regions_count).astype(float)
+    if name_times is None:
+        return no_stops_per_region
+
+    visited = in_grid & (name_times <= max_time)
+    visited_stops_per_region = np.bincount(name_cells[visited], minlength=regions_count)
+    return np.divide(visited_stops_per_region, no_stops_per_region,
+                     out=np.zeros(regions_count), where=no_stops_per_region > 0)
+
+
+def _get_cell_bands(regions_resolution: int, graph_loader: MPKGraphLoader, transfer_cfg: TransferConfig,
+                    max_times: list[int], regions: gpd.GeoDataFrame) -> np.ndarray:
+    # One search up to the largest threshold, then every hex falls into the band of its earliest reached stop;
+    # cells out of reach take the extra, last band
+    t_max = max(max_times)
+    times = _find_times_in_range(graph_loader, TransferConfig(transfer_cfg.start_name, t_max,
+                                                              transfer_cfg.transfer_time,
+                                                              transfer_cfg.departure_time,
+                                                              transfer_cfg.day_type))
+    name_cells = _get_name_cells(regions_resolution, graph_loader, regions)
+    name_times = graph_loader.compiled.name_times(times)
+    reached = (name_cells >= 0) & (name_times <= t_max)
+    cell_times = np.full(len(regions), np.inf)
+    np.minimum.at(cell_times, name_cells[reached], name_times[reached])
+    reached_cells = np.isfinite(cell_times)
+
+    cell_bands = np.full(len(regions), len(max_times))
+    cell_bands[reached_cells] = np.searchsorted(max_times, cell_times[reached_cells], side='left')
+    return cell_bands
+
+
+def _get_name_cells(regions_resolution: int, graph_loader: MPKGraphLoader, regions: gpd.GeoDataFrame) -> np.ndarray:
+    # Position in regions of the cell holding each stop name of the compiled graph, -1 outside the grid
+    compiled = graph_loader.compiled
+    stop_cells = graph_loader.stop_cells(regions_resolution)
+    return regions.index.get_indexer(stop_cells[compiled.name_heads])
+
+
 def _load_stops(graph_loader: MPKGraphLoader) -> gpd.GeoDataFrame:
     stops = []
     for name in graph_loader.stop_names:
@@ -133,22 +271,56 @@ def _load_stops(graph_loader: MPKGraphLoader) -> gpd.GeoDataFrame:
 
 
 def _find_stops_in_range(graph_loader: MPKGraphLoader, transfer_cfg: TransferConfig) -> gpd.GeoDataFrame:
-    stops = graph_loader.get_stops_in_range(transfer_cfg.start_name,
-                                            max_time=transfer_cfg.max_time,
-                                            transfer_time=transfer_cfg.transfer_time)
-    stops = list(stops)
+    with stage('search'):
+        stops = graph_loader.get_stops_in_range(transfer_cfg.start_name,
+                                                max_time=transfer_cfg.max_time,
+                                                transfer_time=transfer_cfg.transfer_time,
+                                                departure_time=transfer_cfg.departure_time,
+                                                day_type=transfer_cfg.day_type)
     stops_arr = []
-    for stop in stops:
+    for stop, time in stops.items():
         d = {
             'region_id': stop.name,
+            'time': time,
             'geometry': Point(stop.lon, stop.lat)
         }
         stops_arr.append(d)
 
     stops = gpd.GeoDataFrame.from_dict(stops_arr)
+    # The same stop name is served by several lines; keep its earliest arrival
+    stops = stops.sort_values('time').drop_duplicates(subset='region_id')
     stops = stops.set_index("region_id")
 
-    return stops.drop_duplicates()
+    return stops
+
+
+def _get_named_stops(graph_loader: MPKGraphLoader, name_ids: np.ndarray) -> gpd.GeoDataFrame:
+    # One point per stop name of the compiled graph, at its first stop
+    compiled = graph_loader.compiled
+    stops = gpd.GeoDataFrame.from_dict([
+        {
+            'region_id': compiled.names[i],
+            'geometry': Point(compiled.stops[compiled.name_heads[i]].lon, compiled.stops[compiled.name_heads[i]].lat)
+        }
+        for i in name_ids
+    ])
+    stops = stops.set_index("region_id")
+
+    return stops
+
+
+def _find_times_in_range(graph_loader: MPKGraphLoader, transfer_cfg: TransferConfig) -> np.ndarray:
+    with stage('search'):
+        return graph_loader.get_times_in_range(transfer_cfg.start_name,
+                                               max_time=transfer_cfg.max_time,
+                                               transfer_time=transfer_cfg.transfer_time,
+                                               departure_time=transfer_cfg.departure_time,
+                                               day_type=transfer_cfg.day_type)
+
+
+def _get_start_ids(graph_loader: MPKGraphLoader, transfer_cfg: TransferConfig) -> list[int]:
+    compiled = graph_loader.compiled
+    return np.unique(compiled.name_ids[compiled.indices_of(transfer_cfg.start_name)]).tolist()
 
 
 def _get_starting_stop(graph_loader: MPKGraphLoader, transfer_cfg: TransferConfig) -> gpd.GeoDataFrame:
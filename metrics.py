@@ -0,0 +1,152 @@
+import bisect
+import threading
+import time
+
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Callable, Iterator, Optional
+
+import ui_config as cfg
+
+ENABLED = cfg.METRICS_ENABLED
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Stages timed so far in the current request, or in a map computation handed to a worker
+_stages: ContextVar[Optional[list[tuple[str, float]]]] = ContextVar('stages', default=None)
+_disabled = nullcontext()
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Registry:
+    # Stage durations per endpoint and event counters of this process, in Prometheus text format
+
+    def __init__(self) -> None:
+        self.histograms: dict[tuple[str, str], Histogram] = {}
+        self.counters: dict[tuple[str, str], int] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, endpoint: str, stages: list[tuple[str, float]]):
+        with self.lock:
+            for name, seconds in stages:
+                self.histograms.setdefault((endpoint, name), Histogram()).observe(seconds)
+
+    def count(self, name: str, result: str):
+        with self.lock:
+            self.counters[(name, result)] = self.counters.get((name, result), 0) + 1
+
+    def render(self) -> list[str]:
+        lines = ['# HELP mpk_stage_seconds Time spent in each stage of a request.',
+                 '# TYPE mpk_stage_seconds histogram']
+        with self.lock:
+            for (endpoint, name), histogram in sorted(self.histograms.items()):
+                labels = f'endpoint="{endpoint}",stage="{name}"'
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'mpk_stage_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f'mpk_stage_seconds_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'mpk_stage_seconds_count{{{labels}}} {cumulative}')
+            lines += ['# HELP mpk_lookups_total Lookups of precomputed and cached results by outcome.',
+                      '# TYPE mpk_lookups_total counter']
+            for (name, result), value in sorted(self.counters.items()):
+                lines.append(f'mpk_lookups_total{{source="{name}",result="{result}"}} {value}')
+        return lines
+
+
+REGISTRY = Registry()
+
+
+def stage(name: str):
+    # `with stage('search'):` times the block for the current request; a shared no-op when metrics are disabled
+    if not ENABLED:
+        return _disabled
+    return _timed(name)
+
+
+@contextmanager
+def _timed(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages = _stages.get()
+        if stages is not None:
+            stages.append((name, time.perf_counter() - start))
+
+
+def count(name: str, result: str):
+    if ENABLED:
+        REGISTRY.count(name, result)
+
+
+def begin():
+    # Starts collecting stages in this context; returns the token for finish()
+    if not ENABLED:
+        return None
+    return _stages.set([])
+
+
+def finish(token, endpoint: str, total: float) -> Optional[list[tuple[str, float]]]:
+    # Stops collecting, records the stages and the total in the registry and returns them
+    if token is None:
+        return None
+    stages = _stages.get() + [('total', total)]
+    _stages.reset(token)
+    REGISTRY.observe(endpoint, stages)
+    return stages
+
+
+def call_collecting(function: Callable, *args) -> tuple[object, list[tuple[str, float]]]:
+    # Runs function in a pool worker and hands its stages back to the request, see merge()
+    if not ENABLED:
+        return function(*args), []
+    token = _stages.set([])
+    try:
+        return function(*args), _stages.get()
+    finally:
+        _stages.reset(token)
+
+
+def merge(stages: list[tuple[str, float]]):
+    current = _stages.get()
+    if current is not None:
+        current.extend(stages)
+
+
+def server_timing(stages: list[tuple[str, float]]) -> str:
+    # Stages run more than once in a request (two maps of a page) are summed
+    durations: dict[str, float] = {}
+    for name, seconds in stages:
+        durations[name] = durations.get(name, 0.0) + seconds
+    return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in durations.items())
+
+
+def render(cache_stats: Optional[dict] = None) -> str:
+    lines = REGISTRY.render()
+    if cache_stats is not None:
+        lines += ['# HELP mpk_result_cache_requests_total Result cache lookups of all workers by outcome.',
+                  '# TYPE mpk_result_cache_requests_total counter']
+        for result in ('hits', 'misses', 'coalesced'):
+            lines.append(f'mpk_result_cache_requests_total{{result="{result}"}} {cache_stats[result]}')
+        lookups = cache_stats['hits'] + cache_stats['misses'] + cache_stats['coalesced']
+        lines += ['# HELP mpk_result_cache_hit_ratio Share of result cache lookups served without computing.',
+                  '# TYPE mpk_result_cache_hit_ratio gauge',
+                  f"mpk_result_cache_hit_ratio {(lookups - cache_stats['misses']) / lookups if lookups else 0.0}",
+                  '# HELP mpk_result_cache_bytes Size of the cached results.',
+                  '# TYPE mpk_result_cache_bytes gauge',
+                  f"mpk_result_cache_bytes {cache_stats['bytes']}",
+                  '# HELP mpk_result_cache_entries Number of cached results.',
+                  '# TYPE mpk_result_cache_entries gauge',
+                  f"mpk_result_cache_entries {cache_stats['entries']}"]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,262 @@
+import argparse
+import re
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+from scipy.sparse.csgraph import connected_components, dijkstra
+
+import ui_config as cfg
+from load_data.compiled_graph import CompiledGraph
+from load_data.load_data import MPKGraphLoader
+from stop_coverage import compute_coverage
+
+CHUNK_SIZE = 64
+Z_95 = 1.96
+README_SECTION = '# Metryki dotyczące grafu komunikacji miejskiej Wrocławia'
+
+_worker_graph: Optional[tuple] = None
+
+
+class NetworkStats:
+    # The graph metrics of statistics.ipynb, from the compiled CSR arrays instead of networkx. Betweenness is
+    # Brandes' algorithm over every source (or a sample of them) split across processes; unweighted figures
+    # count edges like networkx, weighted ones use the edge times in minutes.
+
+    def __init__(self, compiled: CompiledGraph, weighted: bool = False) -> None:
+        self.compiled = compiled
+        self.weighted = weighted
+        n = len(compiled)
+        self.sources = np.repeat(np.arange(n, dtype=np.int32), np.diff(compiled.indptr))
+        self.targets = np.asarray(compiled.indices, dtype=np.int32)
+        self.weights = np.asarray(compiled.times, dtype=np.float64) if weighted else np.ones(len(self.targets))
+        # Shortest paths between two stops of a strongly connected component never leave it
+        _, labels = connected_components(compiled.matrix(), directed=True, connection='strong')
+        self.component = labels == np.bincount(labels).argmax()
+
+    @property
+    def nodes_count(self) -> int:
+        return len(self.compiled)
+
+    @property
+    def edges_count(self) -> int:
+        return self.compiled.edges_count
+
+    @property
+    def density(self) -> float:
+        n = self.nodes_count
+        return self.edges_count / (n * (n - 1)) if n > 1 else 0.0
+
+    def compute(self, samples: Optional[int] = None, seed: int = 0, processes: Optional[int] = None) -> dict:
+        # Diameter and average shortest path of the largest strongly connected component, always from every
+        # source; betweenness of the whole graph, from `samples` random sources when given. Sampled means come
+        # with the half-width of their 95% confidence interval, exact ones with 0.
+        n = self.nodes_count
+        sampled = np.ones(n, dtype=bool)
+        if samples is not None and samples < n:
+            sampled[:] = False
+            sampled[np.random.default_rng(seed).choice(n, samples, replace=False)] = True
+        chunks = [np.arange(i, min(i + CHUNK_SIZE, n)) for i in range(0, n, CHUNK_SIZE)]
+        graph = (self.compiled.matrix(), self.sources, self.targets, self.weights, self.weighted, self.component)
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(graph,)) as executor:
+            rows = list(executor.map(_source_rows, chunks, [sampled[chunk] for chunk in chunks]))
+
+        eccentricities = np.concatenate([row[0] for row in rows])
+        distance_sums = np.concatenate([row[1] for row in rows])
+        node_totals = np.concatenate([row[4] for row in rows])
+        edge_totals = np.concatenate([row[5] for row in rows])
+        node_betweenness = sum(row[2] for row in rows)
+        edge_betweenness = sum(row[3] for row in rows)
+
+        k = int(sampled.sum())
+        node_scale = n / k / ((n - 1) * (n - 2))
+        edge_scale = n / k / (n * (n - 1))
+        component_size = int(self.component.sum())
+        return {
+            'nodes_count': n,
+            'edges_count': self.edges_count,
+            'diameter': eccentricities[self.component].max(),
+            'density': self.density,
+            'node_betweenness': float((node_betweenness * node_scale).mean()),
+            'node_betweenness_error': _mean_error(node_totals, n, node_scale / n),
+            'edge_betweenness': float((edge_betweenness * edge_scale).mean()),
+            'edge_betweenness_error': _mean_error(edge_totals, n, edge_scale / self.edges_count),
+            'avg_shortest_path': float(distance_sums[self.component].sum() / (component_size * (component_size - 1))),
+            'node_betweenness_values': node_betweenness * node_scale,
+            'edge_betweenness_values': edge_betweenness * edge_scale,
+        }
+
+
+def average_hex_area(loader: MPKGraphLoader, regions_resolution: int, max_time: float, transfer_time: float,
+                     processes: Optional[int] = None) -> float:
+    # Mean of map_utils.get_hex_area over every stop name, as statistics.ipynb averages it
+    coverage = compute_coverage(loader, regions_resolution, max_time, transfer_time, processes)
+    areas = coverage['hex_area'].reindex(loader.stop_names).tolist()
+    return sum(areas) / len(areas)
+
+
+def _mean_error(totals: np.ndarray, n: int, scale: float) -> float:
+    # 95% confidence half-width of n/k * sum(totals) * scale, sampling sources without replacement
+    k = len(totals)
+    if k >= n or k < 2:
+        return 0.0
+    standard_error = n * totals.std(ddof=1) / np.sqrt(k) * np.sqrt((n - k) / (n - 1))
+    return float(Z_95 * standard_error * scale)
+
+
+def _init_worker(graph: tuple):
+    global _worker_graph
+    _worker_graph = graph
+
+
+def _source_rows(sources: np.ndarray, sampled: np.ndarray) -> tuple[np.ndarray, ...]:
+    matrix, edge_sources, edge_targets, weights, weighted, component = _worker_graph
+    distances = dijkstra(matrix, directed=True, indices=sources, unweighted=not weighted)
+    within = np.where(component, distances, 0.0)
+    node_betweenness = np.zeros(matrix.shape[0])
+    edge_betweenness = np.zeros(len(edge_targets))
+    node_totals, edge_totals = [], []
+    for source, dist, is_sampled in zip(sources, distances, sampled):
+        if not is_sampled:
+            continue
+        delta, contributions = _dependencies(source, dist, edge_sources, edge_targets, weights)
+        node_betweenness += delta
+        edge_betweenness += contributions
+        node_totals.append(delta.sum())
+        edge_totals.append(contributions.sum())
+    return within.max(axis=1), within.sum(axis=1), node_betweenness, edge_betweenness, \
+        np.array(node_totals), np.array(edge_totals)
+
+
+def _dependencies(source: int, dist: np.ndarray, edge_sources: np.ndarray, edge_targets: np.ndarray,
+                  weights: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Brandes' dependencies of every stop and edge on the shortest paths from source. Edges on a shortest
+    # path are grouped by the distance of their target and walked level by level; zero-minute edges join
+    # stops of one level and are settled by iterating to a fixed point. Times are whole minutes, so
+    # distances compare exactly.
+    n = len(dist)
+    tight = np.flatnonzero(np.isfinite(dist[edge_sources]) & (dist[edge_sources] + weights == dist[edge_targets])
+                           & (edge_targets != source))
+    tight = tight[np.argsort(dist[edge_targets[tight]], kind='stable')]
+    levels = np.split(tight, np.flatnonzero(np.diff(dist[edge_targets[tight]])) + 1) if len(tight) else []
+
+    sigma = np.zeros(n)
+    sigma[source] = 1.0
+    for edges in levels:
+        e_sources, e_targets = edge_sources[edges], edge_targets[edges]
+        same = dist[e_sources] == dist[e_targets]
+        np.add.at(sigma, e_targets[~same], sigma[e_sources[~same]])
+        if same.any():
+            base = sigma.copy()
+            for _ in range(len(edges)):
+                updated = base.copy()
+                np.add.at(updated, e_targets[same], sigma[e_sources[same]])
+                if np.array_equal(updated, sigma):
+                    break
+                sigma = updated
+
+    delta = np.zeros(n)
+    contributions = np.zeros(len(edge_targets))
+    for edges in reversed(levels):
+        e_sources, e_targets = edge_sources[edges], edge_targets[edges]
+        same = dist[e_sources] == dist[e_targets]
+        if same.any():
+            base = delta.copy()
+            for _ in range(len(edges) + 1):
+                shares = sigma[e_sources[same]] / sigma[e_targets[same]] * (1 + delta[e_targets[same]])
+                updated = base.copy()
+                np.add.at(updated, e_sources[same], shares)
+                if np.array_equal(updated, delta):
+                    break
+                delta = updated
+            contributions[edges[same]] = shares
+        shares = sigma[e_sources[~same]] / sigma[e_targets[~same]] * (1 + delta[e_targets[~same]])
+        contributions[edges[~same]] = shares
+        np.add.at(delta, e_sources[~same], shares)
+    delta[source] = 0.0
+    return delta, contributions
+
+
+def readme_table(columns: dict[str, dict], max_time: Optional[float], transfer_time: float) -> str:
+    rows = [
+        ('Nodes count', 'nodes_count'),
+        ('Edges count', 'edges_count'),
+        ('Diameter', 'diameter'),
+        ('Density', 'density'),
+        ('Node betweenness centrality', 'node_betweenness'),
+        ('Edge betweenness centrality', 'edge_betweenness'),
+        ('Avg shortest path', 'avg_shortest_path'),
+        ('Diameter [min]', 'weighted_diameter'),
+        ('Node betweenness centrality [min]', 'weighted_node_betweenness'),
+        ('Edge betweenness centrality [min]', 'weighted_edge_betweenness'),
+        ('Avg shortest path [min]', 'weighted_avg_shortest_path'),
+        ('Avg area', 'avg_area'),
+    ]
+    lines = [f"|metric|{'|'.join(columns)}|", f"|:-----|{'|'.join('---:' for _ in columns)}|"]
+    for label, key in rows:
+        if all(key in stats for stats in columns.values()):
+            lines.append(f"|{label}|{'|'.join(_format(stats[key], stats.get(f'{key}_error')) for stats in columns.values())}|")
+    if max_time is not None:
+        lines += ['', f'**max_time: {max_time:g}**', f'**transfer_time: {transfer_time:g}**']
+    return '\n'.join(lines) + '\n'
+
+
+def _format(value, error: Optional[float]) -> str:
+    value = value.item() if isinstance(value, np.generic) else value
+    if isinstance(value, float) and value.is_integer() and not error:
+        value = int(value)
+    return f'{value} ± {error:.2g}' if error else f'{value}'
+
+
+def update_readme(path: str, table: str):
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    if README_SECTION not in text:
+        raise ValueError(f'{path} has no "{README_SECTION}" section.')
+    head, _, tail = text.partition(README_SECTION)
+    # The section runs to the next heading or the end of the file
+    next_heading = re.search(r'^#', tail[1:], flags=re.MULTILINE)
+    rest = tail[next_heading.start() + 1:] if next_heading else ''
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f'{head}{README_SECTION}\n\n{table}' + (f'\n{rest}' if rest else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute the network metrics of the readme for every loader.')
+    parser.add_argument('loaders', nargs='*', help=f'loader names, all of {", ".join(cfg.LOADER_PATHS)} by default')
+    parser.add_argument('--samples', type=int, default=None, help='betweenness from this many random sources')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--weighted', action='store_true', help='also add metrics over edge times in minutes')
+    parser.add_argument('--no-area', action='store_true', help='skip the average hex area (needs the city grid)')
+    parser.add_argument('--max-time', type=float, default=30)
+    parser.add_argument('--transfer-time', type=float, default=5)
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, all cores by default')
+    parser.add_argument('--readme', default=None, help='rewrite the metrics table of this readme')
+    args = parser.parse_args()
+
+    columns = {}
+    for name in args.loaders or list(cfg.LOADER_PATHS):
+        start = time.perf_counter()
+        loader_path = cfg.LOADER_PATHS[name]
+        loader = MPKGraphLoader.from_path(loader_path)
+        stats = NetworkStats(loader.compiled).compute(args.samples, args.seed, args.processes)
+        if args.weighted:
+            weighted = NetworkStats(loader.compiled, weighted=True).compute(args.samples, args.seed, args.processes)
+            stats.update({f'weighted_{key}': value for key, value in weighted.items()})
+        if not args.no_area:
+            stats['avg_area'] = average_hex_area(loader, cfg.DEFAULT_REGIONS_RESOLUTION, args.max_time,
+                                                 args.transfer_time, args.processes)
+        columns[name] = stats
+        print(f'{name}: {time.perf_counter() - start:.1f} s')
+
+    table = readme_table(columns, None if args.no_area else args.max_time, args.transfer_time)
+    print(table)
+    if args.readme:
+        update_readme(args.readme, table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import os
+import threading
+
+from functools import lru_cache
+
+import geopandas as gpd
+
+from srai.regionalizers import geocode_to_region_gdf, H3Regionalizer
+
+CITY = "Wroclaw"
+COUNTRY = "Poland"
+
+REGIONS_DIR = os.path.join('.', 'data', 'regions')
+
+
+class RegionStore:
+    # City boundary and its H3 grids, kept on disk so a map request never geocodes or regionalizes.
+    # A boundary.geojson bundled in the directory is used as is; otherwise the area is geocoded once.
+
+    def __init__(self, regions_dir: str = REGIONS_DIR, area_name: str = f"{CITY}, {COUNTRY}") -> None:
+        self.regions_dir = regions_dir
+        self.area_name = area_name
+        self._area = None
+        self._regions: dict[int, gpd.GeoDataFrame] = {}
+        self._geojson: dict[int, dict] = {}
+        self._lock = threading.RLock()
+
+    @property
+    def boundary_path(self) -> str:
+        return os.path.join(self.regions_dir, 'boundary.geojson')
+
+    def grid_path(self, resolution: int) -> str:
+        return os.path.join(self.regions_dir, f'h3_{resolution}.geojson')
+
+    @property
+    def area(self) -> gpd.GeoDataFrame:
+        with self._lock:
+            if self._area is None:
+                if os.path.exists(self.boundary_path):
+                    self._area = _read(self.boundary_path)
+                else:
+                    self._area = geocode_to_region_gdf(self.area_name)
+                    _write(self._area, self.boundary_path)
+        return self._area
+
+    def regions(self, resolution: int) -> gpd.GeoDataFrame:
+        # Both maps of a page may ask for a grid not built yet, it is built once
+        with self._lock:
+            if resolution not in self._regions:
+                path = self.grid_path(resolution)
+                if os.path.exists(path):
+                    regions = _read(path)
+                else:
+                    regions = H3Regionalizer(resolution).transform(self.area)
+                    _write(regions, path)
+                self._regions[resolution] = regions
+        # Callers add columns to the grid, the cached frame stays untouched
+        return self._regions[resolution].copy()
+
+    def geojson(self, resolution: int) -> dict:
+        # The grid as a FeatureCollection in regions() order, cell ids as feature ids and coordinates
+        # rounded to about 10 cm, which keeps rendered maps small
+        with self._lock:
+            if resolution not in self._geojson:
+                regions = self.regions(resolution)
+                self._geojson[resolution] = {
+                    'type': 'FeatureCollection',
+                    'features': [
+                        {'type': 'Feature', 'id': cell, 'properties': {},
+                         'geometry': _round(geometry.__geo_interface__)}
+                        for cell, geometry in zip(regions.index, regions.geometry)
+                    ],
+                }
+        return self._geojson[resolution]
+
+
+@lru_cache(maxsize=None)
+def get_region_store() -> RegionStore:
+    return RegionStore()
+
+
+def _round(geometry: dict, digits: int = 6) -> dict:
+    def round_coordinates(coordinates):
+        if isinstance(coordinates[0], (int, float)):
+            return [round(value, digits) for value in coordinates]
+        return [round_coordinates(part) for part in coordinates]
+    return {'type': geometry['type'], 'coordinates': round_coordinates(geometry['coordinates'])}
+
+
+def _read(path: str) -> gpd.GeoDataFrame:
+    return gpd.read_file(path).set_index('region_id')
+
+
+def _write(gdf: gpd.GeoDataFrame, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    gdf.rename_axis('region_id').reset_index().to_file(tmp_path, driver='GeoJSON')
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fetch the city boundary and precompute its H3 grids, '
+                                                 'e.g. before copying data/regions to an offline machine.')
+    parser.add_argument('resolutions', nargs='+', type=int)
+    parser.add_argument('--regions-dir', default=REGIONS_DIR)
+    args = parser.parse_args()
+    store = RegionStore(args.regions_dir)
+    for resolution in args.resolutions:
+        regions = store.regions(resolution)
+        print(f'{store.grid_path(resolution)}: {len(regions)} cells')
+
+
+if __name__ == '__main__':
+    main()
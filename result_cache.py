@@ -0,0 +1,187 @@
+import os
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+
+class ResultCache:
+    # Rendered results in one SQLite file shared by every worker process. Entries are evicted least recently
+    # used first once their total size passes max_bytes. Only one thread or process computes a missing key,
+    # the others wait for its result.
+
+    def __init__(self, path: str, max_bytes: int, lock_timeout: float = 120.0, poll_interval: float = 0.05) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._key_locks: dict[str, list] = {}
+        self._key_locks_guard = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.__transaction() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS entries '
+                               '(key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+            connection.execute('CREATE TABLE IF NOT EXISTS pending (key TEXT PRIMARY KEY, expires REAL NOT NULL, '
+                               'owner INTEGER)')
+            # Files created before claims recorded the process holding them
+            if 'owner' not in [row[1] for row in connection.execute('PRAGMA table_info(pending)')]:
+                connection.execute('ALTER TABLE pending ADD COLUMN owner INTEGER')
+            connection.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+    def get_or_compute(self, key: str, compute: Callable[[], str]) -> str:
+        value = self.get(key)
+        if value is not None:
+            self.__count('hits')
+            return value
+
+        with self.__key_lock(key):
+            # Another thread of this process may have filled the entry while we waited for the lock
+            value = self.get(key)
+            if value is not None:
+                self.__count('coalesced')
+                return value
+            claimed = self.__claim(key)
+            if not claimed:
+                value = self.__wait(key)
+                if value is not None:
+                    self.__count('coalesced')
+                    return value
+            try:
+                self.__count('misses')
+                value = compute()
+                self.put(key, value)
+                return value
+            finally:
+                if claimed:
+                    self.__release(key)
+
+    def get(self, key: str) -> Optional[str]:
+        connection = self.__connection()
+        row = connection.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        connection.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+        return row[0].decode('utf-8')
+
+    def put(self, key: str, value: str):
+        data = value.encode('utf-8')
+        if len(data) > self.max_bytes:
+            return
+        with self.__transaction() as connection:
+            connection.execute('INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)',
+                               (key, data, len(data), time.time()))
+            total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total > self.max_bytes:
+                self.__evict(connection, total - self.max_bytes)
+
+    def clear(self):
+        with self.__transaction() as connection:
+            connection.execute('DELETE FROM entries')
+            connection.execute('DELETE FROM stats')
+
+    def release_claims(self, owner: int) -> int:
+        # Frees the keys a stopped worker process (pid owner) was computing, so nobody waits for them
+        with self.__transaction() as connection:
+            return connection.execute('DELETE FROM pending WHERE owner = ?', (owner,)).rowcount
+
+    def stats(self) -> dict[str, int]:
+        connection = self.__connection()
+        ret = {name: 0 for name in ('hits', 'misses', 'coalesced')}
+        ret.update(dict(connection.execute('SELECT name, value FROM stats').fetchall()))
+        entries, size = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        ret.update(entries=entries, bytes=size, max_bytes=self.max_bytes)
+        return ret
+
+    def __evict(self, connection: sqlite3.Connection, excess: int):
+        keys = []
+        for key, size in connection.execute('SELECT key, size FROM entries ORDER BY accessed'):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        connection.executemany('DELETE FROM entries WHERE key = ?', keys)
+
+    def __claim(self, key: str) -> bool:
+        now = time.time()
+        with self.__transaction() as connection:
+            # A worker that died mid-computation leaves its claim behind until it expires
+            connection.execute('DELETE FROM pending WHERE key = ? AND expires < ?', (key, now))
+            cursor = connection.execute('INSERT OR IGNORE INTO pending (key, expires, owner) VALUES (?, ?, ?)',
+                                        (key, now + self.lock_timeout, os.getpid()))
+            return cursor.rowcount == 1
+
+    def __release(self, key: str):
+        self.__connection().execute('DELETE FROM pending WHERE key = ?', (key,))
+
+    def __wait(self, key: str) -> Optional[str]:
+        # None when the computing worker gave up or timed out, the caller computes the value itself then
+        deadline = time.time() + self.lock_timeout
+        connection = self.__connection()
+        while time.time() < deadline:
+            value = self.get(key)
+            if value is not None:
+                return value
+            if connection.execute('SELECT 1 FROM pending WHERE key = ? AND expires >= ?',
+                                  (key, time.time())).fetchone() is None:
+                return self.get(key)
+            time.sleep(self.poll_interval)
+        return None
+
+    def __count(self, name: str):
+        self.__connection().execute('INSERT INTO stats (name, value) VALUES (?, 1) '
+                                    'ON CONFLICT (name) DO UPDATE SET value = value + 1', (name,))
+
+    def __key_lock(self, key: str) -> "_KeyLock":
+        return _KeyLock(self._key_locks, self._key_locks_guard, key)
+
+    @contextmanager
+    def __transaction(self) -> Iterator[sqlite3.Connection]:
+        connection = self.__connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def __connection(self) -> sqlite3.Connection:
+        # Autocommit connections, one per thread; sqlite3 connections must not cross threads and
+        # forked workers open their own on first use
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+
+class _KeyLock:
+    # Per-key threading lock, dropped again once no thread holds or waits for it
+
+    def __init__(self, locks: dict[str, list], guard: threading.Lock, key: str) -> None:
+        self.locks = locks
+        self.guard = guard
+        self.key = key
+
+    def __enter__(self):
+        with self.guard:
+            entry = self.locks.setdefault(self.key, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+
+    def __exit__(self, *args):
+        with self.guard:
+            entry = self.locks[self.key]
+            entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[self.key]
@@ -0,0 +1,114 @@
+import argparse
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import geopandas as gpd
+import numpy as np
+
+from scipy.sparse.csgraph import dijkstra
+from shapely.geometry import Point
+
+import ui_config as cfg
+from load_data.load_data import MPKGraphLoader
+from map_utils import _get_name_cells
+from region_store import get_region_store
+
+CHUNK_SIZE = 64
+
+_worker_graph: Optional[tuple] = None
+
+
+def compute_coverage(graph_loader: MPKGraphLoader, regions_resolution: int, max_time: float, transfer_time: float,
+                     processes: Optional[int] = None) -> gpd.GeoDataFrame:
+    # get_hex_area of every stop name at once, one row per name of compiled.names:
+    #   reached_stops  - stop names reached within max_time, the origin included
+    #   covered_cells  - grid cells with at least one reached stop
+    #   hex_area       - sum over cells of the reached share of their stops, what get_hex_area returns
+    #   coverage_ratio - covered_cells over the cells holding any stop
+    compiled = graph_loader.compiled
+    regions = get_region_store().regions(regions_resolution)
+    name_cells = _get_name_cells(regions_resolution, graph_loader, regions)
+    # Columns of the search result grouped by name, so one reduceat gives the earliest arrival per name
+    columns = np.argsort(compiled.name_ids, kind='stable')
+    name_bounds = np.flatnonzero(np.diff(compiled.name_ids[columns], prepend=-1))
+    graph = (compiled.matrix(transfer_time), columns, name_bounds, name_cells, len(regions), max_time)
+
+    origins = [compiled.indices_of(name) for name in compiled.names]
+    chunks = [origins[i:i + CHUNK_SIZE] for i in range(0, len(origins), CHUNK_SIZE)]
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(graph,)) as executor:
+        rows = list(executor.map(_coverage_rows, chunks))
+
+    reached_stops, covered_cells, hex_area = (np.concatenate([row[i] for row in rows]) for i in range(3))
+    stop_cells_count = np.count_nonzero(np.bincount(name_cells[name_cells >= 0], minlength=len(regions)))
+    heads = [compiled.stops[i] for i in compiled.name_heads]
+    return gpd.GeoDataFrame(
+        {
+            'reached_stops': reached_stops,
+            'covered_cells': covered_cells,
+            'hex_area': hex_area,
+            'coverage_ratio': covered_cells / stop_cells_count if stop_cells_count else 0.0,
+        },
+        geometry=[Point(stop.lon, stop.lat) for stop in heads],
+        index=gpd.pd.Index(compiled.names, name='name'),
+        crs='EPSG:4326'
+    )
+
+
+def _init_worker(graph: tuple):
+    global _worker_graph
+    _worker_graph = graph
+
+
+def _coverage_rows(origins: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    matrix, columns, name_bounds, name_cells, regions_count, max_time = _worker_graph
+    sources = np.concatenate(origins)
+    if len(sources) == 0:
+        empty = np.zeros(len(origins))
+        return empty.astype(np.int64), empty.astype(np.int64), empty
+
+    # Every stop of every origin in one search; an origin name starts from all of its stops at once
+    times = dijkstra(matrix, directed=True, indices=sources, limit=max_time)
+    lengths = np.array([len(origin) for origin in origins])
+    origin_times = np.full((len(origins), times.shape[1]), np.inf)
+    searched = lengths > 0
+    origin_times[searched] = np.minimum.reduceat(times, np.cumsum(lengths)[searched] - lengths[searched], axis=0)
+    name_times = np.minimum.reduceat(origin_times[:, columns], name_bounds, axis=1)
+
+    in_grid = name_cells >= 0
+    totals = np.bincount(name_cells[in_grid], minlength=regions_count)
+    reached = name_times <= max_time
+    visited_rows, visited_names = np.nonzero(reached & in_grid)
+    visited = np.bincount(visited_rows * regions_count + name_cells[visited_names],
+                          minlength=len(origins) * regions_count).reshape(len(origins), regions_count)
+    shares = np.divide(visited, totals, out=np.zeros(visited.shape), where=totals > 0)
+    # Summed over the covered cells only, exactly as get_hex_area sums its "count > 0" rows
+    hex_area = np.array([row[row > 0].sum() for row in shares])
+    return reached.sum(axis=1), np.count_nonzero(visited, axis=1), hex_area
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Coverage of the city grid from every stop of a network, '
+                                                 'saved as CSV or GeoJSON.')
+    parser.add_argument('loader', help=f'loader name, one of {", ".join(cfg.LOADER_PATHS)}')
+    parser.add_argument('output', help='.csv or .geojson file')
+    parser.add_argument('--max-time', type=float, default=30)
+    parser.add_argument('--transfer-time', type=float, default=cfg.DEFAULT_TRANSFER_TIME)
+    parser.add_argument('--resolution', type=int, default=cfg.DEFAULT_REGIONS_RESOLUTION)
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, all cores by default')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    loader = MPKGraphLoader.from_path(cfg.LOADER_PATHS[args.loader])
+    coverage = compute_coverage(loader, args.resolution, args.max_time, args.transfer_time, args.processes)
+    if args.output.endswith('.geojson'):
+        coverage.reset_index().to_file(args.output, driver='GeoJSON')
+    else:
+        coverage.drop(columns='geometry').to_csv(args.output)
+    print(f'{args.output}: {len(coverage)} stops in {time.perf_counter() - start:.1f} s, '
+          f"average hex area {coverage['hex_area'].mean():.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import networkx as nx
+import numpy as np
+
+from load_data.compiled_graph import CompiledGraph
+from load_data.ingest import ParsedLine, StopTimetable
+from load_data.load_data import Stop
+from load_data.timetable import WEEKDAY, Timetable
+
+
+def _line_timetable(names: list[str], run_times: list[int], departure: int) -> tuple[CompiledGraph, Timetable]:
+    # One line running a single trip through names, leaving the first stop at departure
+    stops = [Stop(name, i, 51.1, 17.0, '1') for i, name in enumerate(names)]
+    graph = nx.DiGraph()
+    for (u, v), run_time in zip(zip(stops, stops[1:]), run_times):
+        graph.add_edge(u, v, time=run_time, kind='ride')
+    compiled = CompiledGraph.from_graph(graph)
+
+    variant, minute = [], departure
+    for i, name in enumerate(names):
+        last = i == len(names) - 1
+        variant.append(StopTimetable(name, i, None if last else names[i + 1], None if last else i + 1,
+                                     0 if last else run_times[i], {WEEKDAY: [minute]}))
+        minute += 0 if last else run_times[i]
+    return compiled, Timetable.from_lines([ParsedLine('1.xml', '1', {}, {1: variant})], compiled)
+
+
+def test_zero_minute_hops_chain_within_the_same_minute():
+    # The second hop leaves from a stop that sorts before the first hop's origin
+    compiled, timetable = _line_timetable(['zoo', 'most', 'dworzec'], [0, 0], 600)
+    start = compiled.index_of(Stop('zoo', 0, None, None, '1'))
+    arrival = timetable.earliest_arrival([start], 600, max_time=10)
+    assert arrival[compiled.index_of(Stop('dworzec', 0, None, None, '1'))] == 0
+    assert arrival[compiled.index_of(Stop('most', 0, None, None, '1'))] == 0
+
+
+def test_connections_are_sorted_by_departure():
+    compiled, timetable = _line_timetable(['zoo', 'most', 'dworzec', 'arkady'], [0, 3, 0], 600)
+    connections = timetable.connections[WEEKDAY]
+    assert np.all(np.diff(connections['dep']) >= 0)
+    arrival = timetable.earliest_arrival([compiled.index_of(Stop('zoo', 0, None, None, '1'))], 600)
+    assert arrival[compiled.index_of(Stop('arkady', 0, None, None, '1'))] == 3
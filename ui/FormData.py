@@ -7,4 +7,6 @@ class FormData:
     stop_id: int
     stop_display_name: str
     transfer_time: Optional[int]
-    stop_reach_max_time: int
\ No newline at end of file
+    stop_reach_max_time: int
+    departure: str
+    day_type: str
\ No newline at end of file
@@ -1,8 +1,24 @@
 import hashlib
+import heapq
+import re
+import unicodedata
 from dataclasses import dataclass
 
 from load_data.load_data import MPKGraphLoader
 
+# Letters NFKD leaves whole
+_FOLDED_LETTERS = str.maketrans({'ł': 'l', 'ß': 'ss', 'æ': 'ae', 'ø': 'o'})
+# Spelled-out words typed for the abbreviations used in stop names
+_ABBREVIATIONS = {'plac': 'pl', 'osiedle': 'os', 'swietego': 'sw', 'swietej': 'sw', 'rotmistrza': 'rotm'}
+_SEPARATORS = re.compile(r'[^0-9a-z]+')
+
+
+def fold(text: str) -> str:
+    # Lowercase, without diacritics and punctuation: "Pl. Grunwaldzki" and "pl grunwaldzki" fold the same
+    text = unicodedata.normalize('NFKD', text.lower().translate(_FOLDED_LETTERS))
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return _SEPARATORS.sub(' ', text).strip()
+
 
 @dataclass
 class StopDTO:
@@ -23,14 +39,60 @@ class StopRepository:
         self.stops: dict[str, StopDTO] = {
             stop.id: stop for stop in stops
         }
+        self.__build_index()
 
     def get_by_id(self, ident: str):
         return self.stops[ident]
 
-    def query(self, stop_name: str) -> list[StopDTO]:
-        normalized_query = stop_name.lower()
-        matching_stops = [stop for stop in self.stops.values() if normalized_query in stop.name.lower()]
-        return matching_stops
+    def query(self, stop_name: str, limit: int = 20) -> list[StopDTO]:
+        # Best `limit` matches: names starting with the query, then names with every query word starting
+        # a word, then names merely containing the query words; shorter names first within a tier
+        words = [_ABBREVIATIONS.get(word, word) for word in fold(stop_name).split()]
+        if not words:
+            return self._by_name[:limit]
+
+        candidates = None
+        for word in sorted(words, key=len, reverse=True):
+            word_candidates = self.__candidates(word)
+            candidates = word_candidates if candidates is None else candidates & word_candidates
+            if not candidates:
+                return []
+
+        phrase = ' '.join(words)
+        ranked = []
+        for position in candidates:
+            folded = self._folded[position]
+            if not all(word in folded for word in words):
+                continue
+            if folded.startswith(phrase):
+                tier = 0
+            elif all(f' {word}' in f' {folded}' for word in words):
+                tier = 1
+            else:
+                tier = 2
+            ranked.append((tier, len(folded), folded, position))
+        return [self._by_name[position] for *_, position in heapq.nsmallest(limit, ranked)]
+
+    def __candidates(self, word: str) -> frozenset[int]:
+        # Words shorter than a trigram only match at the start of a name word
+        if len(word) < 3:
+            return self._prefixes.get(word, frozenset())
+        trigrams = sorted((self._trigrams.get(word[i:i + 3], frozenset()) for i in range(len(word) - 2)), key=len)
+        return frozenset.intersection(*trigrams)
+
+    def __build_index(self):
+        self._by_name: list[StopDTO] = sorted(self.stops.values(), key=lambda stop: stop.name)
+        self._folded: list[str] = [fold(stop.name) for stop in self._by_name]
+        prefixes: dict[str, set[int]] = {}
+        trigrams: dict[str, set[int]] = {}
+        for position, folded in enumerate(self._folded):
+            for word in folded.split():
+                for length in (1, 2):
+                    prefixes.setdefault(word[:length], set()).add(position)
+            for i in range(len(folded) - 2):
+                trigrams.setdefault(folded[i:i + 3], set()).add(position)
+        self._prefixes = {key: frozenset(positions) for key, positions in prefixes.items()}
+        self._trigrams = {key: frozenset(positions) for key, positions in trigrams.items()}
 
     @staticmethod
     def from_loaders(loaders: list[MPKGraphLoader]):
@@ -1,3 +1,15 @@
+import os
+from typing import Optional
+
+LOADER_PATHS: dict[str, str] = {
+    "all_2023": './data/mpk_graph_loader_2023.snapshot',
+    "all_2024": './data/mpk_graph_loader_2024.snapshot',
+    "tram_2023": './data/tram_graph_loader_2023.snapshot',
+    "tram_2024": './data/tram_graph_loader_2024.snapshot',
+    "bus_2023": './data/bus_graph_loader_2023.snapshot',
+    "bus_2024": './data/bus_graph_loader_2024.snapshot'
+}
+
 DEFAULT_REGIONS_RESOLUTION: int = 8
 DEFAULT_TRANSFER_TIME: int = 5
 DEFAULT_STOP_REACH_MAX_TIME: int = 20  # Consider stops which are accessible within 5 minutes
@@ -6,4 +18,21 @@ DEFAULT_STOP_REACH_MAX_TIME_LIST: list[int] = [5, 15, 30, 45, 60, 75]
 # MAP
 DEFAULT_MAP_START_ZOOM: int = 2
 
-DEFAULT_STARTING_STOP_IDENT: str = "f970af11d033cf4c605c666d00142a87"   # pl grun
\ No newline at end of file
+DEFAULT_STARTING_STOP_IDENT: str = "f970af11d033cf4c605c666d00142a87"   # pl grun
+STOP_SEARCH_LIMIT: int = 20  # suggestions returned per /search_stops request
+
+# RESULT CACHE
+RESULT_CACHE_PATH: str = './data/.result_cache.sqlite'
+RESULT_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+RESULT_CACHE_LOCK_TIMEOUT: float = 20.0  # seconds a result is waited for from another worker, below MAP_TIMEOUT
+
+# METRICS
+METRICS_ENABLED: bool = True  # stage timings in Server-Timing headers and /metrics
+
+# MAP WORKERS
+MAP_WORKER_KIND: str = 'process'  # 'process' or 'thread'; rendering folium HTML holds the GIL
+MAP_WORKERS: int = 4
+MAP_TIMEOUT: float = 60.0  # seconds, a page whose maps take longer answers 504
+
+# SCENARIOS
+SCENARIO_TOKEN: Optional[str] = os.environ.get('SCENARIO_TOKEN')  # enables /scenario/<loader>, off while unset
@@ -1,6 +1,8 @@
 import matplotlib.pyplot as plt
 from typing import Tuple
 import geopandas as gpd
+import numpy as np
+import pandas as pd
 from tqdm import tqdm
 
 CB_SAFE_PALLETE = [
@@ -120,14 +122,42 @@ def map_flats(flats_value: str) -> int:
     return flats
 
 
-def interpolate_spatial_data(regions, features, weight_column, result_column):
-    for bsu in tqdm(regions.to_dict(orient="records")):
-        matching_features = features[features.intersects(bsu["geometry"])]
-        total_value = matching_features[weight_column].sum()
-        for feature_index, feature_row in matching_features.iterrows():
-            features.loc[feature_index, result_column] = bsu[result_column] * (
-                feature_row[weight_column] / total_value
-            )
+def interpolate_spatial_data(regions, features, weight_column, result_column, chunk_size=None):
+    # Splits each region's result_column between the features intersecting it, in proportion to
+    # weight_column. A feature intersecting several regions keeps the share of the last one.
+    # With chunk_size, the spatial index is built over that many features at a time.
+    chunk_size = chunk_size or max(len(features), 1)
+    region_positions, feature_positions = [], []
+    for start in tqdm(range(0, len(features), chunk_size)):
+        chunk = features.geometry.iloc[start:start + chunk_size]
+        regions_idx, features_idx = chunk.sindex.query(regions.geometry.values, predicate="intersects")
+        region_positions.append(regions_idx)
+        feature_positions.append(features_idx + start)
+    region_positions = np.concatenate(region_positions or [[]]).astype(np.int64)
+    feature_positions = np.concatenate(feature_positions or [[]]).astype(np.int64)
+    if len(feature_positions) == 0:
+        return
+
+    # Features of one region in frame order, so each total is summed exactly like Series.sum
+    order = np.lexsort((feature_positions, region_positions))
+    region_positions, feature_positions = region_positions[order], feature_positions[order]
+    weights = features[weight_column].to_numpy()
+    matching_weights = weights[feature_positions]
+    bounds = np.flatnonzero(np.diff(region_positions)) + 1
+    totals = np.array([
+        pd.Series(part).sum() for part in np.split(matching_weights, bounds)
+    ])
+    totals = np.repeat(totals, np.diff(np.concatenate([[0], bounds, [len(region_positions)]])))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values = regions[result_column].to_numpy()[region_positions] * (matching_weights / totals)
+
+    # Pairs are sorted by region, so the last pair of every feature belongs to its last region
+    last = np.unique(feature_positions[::-1], return_index=True)[1]
+    last = len(feature_positions) - 1 - last
+    if result_column not in features.columns:
+        features[result_column] = np.nan
+    features.iloc[feature_positions[last], features.columns.get_loc(result_column)] = values[last]
 
 
 def plot_population(buildings):
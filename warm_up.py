@@ -0,0 +1,196 @@
+import argparse
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+import ui_config as cfg
+from load_data.compiled_graph import CompiledGraph
+from load_data.load_data import MPKGraphLoader
+from map_utils import TransferConfig, _get_cell_bands, _get_cell_counts, _get_colors_from_cmap, _get_name_cells, \
+    _get_start_ids, _find_times_in_range
+from region_store import get_region_store
+
+CHUNK_SIZE = 64
+
+_worker_loader: Optional[MPKGraphLoader] = None
+
+
+class WarmResults:
+    # Isochrone bands and default-map coverage of every stop name of one loader, for a single parameter set.
+    # Rows follow compiled.names, cell columns follow the region grid; get_izochrone_data and get_map_data
+    # answers are rebuilt from them without a search.
+
+    def __init__(self, params: dict, bands: np.ndarray, visited: np.ndarray, reached: np.ndarray) -> None:
+        self.params = params
+        self.bands = bands  # names x cells, len(max_times) where a cell is out of reach
+        self.visited = visited  # names x cells, stops reached within max_time per cell
+        self.reached = reached  # names x packed names, stops reached within max_time
+
+    @staticmethod
+    def default_params() -> dict:
+        return {
+            'resolution': cfg.DEFAULT_REGIONS_RESOLUTION,
+            'transfer_time': cfg.DEFAULT_TRANSFER_TIME,
+            'max_time': cfg.DEFAULT_STOP_REACH_MAX_TIME,
+            'max_times': sorted(cfg.DEFAULT_STOP_REACH_MAX_TIME_LIST),
+        }
+
+    @staticmethod
+    def compute(loader_path: str, params: dict, processes: Optional[int] = None) -> "WarmResults":
+        loader = MPKGraphLoader.from_path(loader_path)
+        names = loader.compiled.names
+        chunks = [names[i:i + CHUNK_SIZE] for i in range(0, len(names), CHUNK_SIZE)]
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(loader_path,)) as executor:
+            rows = list(executor.map(_warm_rows, chunks, [params] * len(chunks)))
+        return WarmResults(
+            params,
+            np.concatenate([row[0] for row in rows]),
+            np.concatenate([row[1] for row in rows]),
+            np.concatenate([row[2] for row in rows]),
+        )
+
+    @staticmethod
+    def path_for(loader_path: str, compiled: CompiledGraph) -> str:
+        base, _ = os.path.splitext(loader_path)
+        return f'{base}.warm.{compiled.fingerprint}.npz'
+
+    @staticmethod
+    def find(loader_path: str, compiled: CompiledGraph) -> Optional["WarmResults"]:
+        path = WarmResults.path_for(loader_path, compiled)
+        if not os.path.exists(path):
+            return None
+        return WarmResults.load(path)
+
+    def save(self, path: str):
+        np.savez_compressed(
+            path, bands=self.bands, visited=self.visited, reached=self.reached,
+            resolution=self.params['resolution'], transfer_time=self.params['transfer_time'],
+            max_time=self.params['max_time'], max_times=np.array(self.params['max_times'])
+        )
+
+    @staticmethod
+    def load(path: str) -> "WarmResults":
+        with np.load(path) as data:
+            params = {
+                'resolution': int(data['resolution']),
+                'transfer_time': data['transfer_time'].item(),
+                'max_time': data['max_time'].item(),
+                'max_times': data['max_times'].tolist(),
+            }
+            return WarmResults(params, data['bands'], data['visited'], data['reached'])
+
+    def cell_bands(self, graph_loader: MPKGraphLoader, regions_resolution: int, transfer_cfg: TransferConfig,
+                   max_times: list[int]) -> Optional[np.ndarray]:
+        # Same bands as map_utils._get_cell_bands, None when the request is not covered
+        row = self.__row(graph_loader, regions_resolution, transfer_cfg)
+        if row is None or sorted(max_times) != self.params['max_times']:
+            return None
+        return self.bands[row].astype(np.int64)
+
+    def coverage(self, graph_loader: MPKGraphLoader, regions_resolution: int,
+                 transfer_cfg: TransferConfig) -> Optional[tuple[np.ndarray, np.ndarray]]:
+        # Reached share of stops per cell and the mask of reached stop names, None when the request is not covered
+        row = self.__row(graph_loader, regions_resolution, transfer_cfg)
+        if row is None or transfer_cfg.max_time != self.params['max_time']:
+            return None
+        regions = get_region_store().regions(regions_resolution)
+        totals = _get_cell_counts(_get_name_cells(regions_resolution, graph_loader, regions), len(regions))
+        values = np.divide(self.visited[row], totals, out=np.zeros(len(regions)), where=totals > 0)
+        reached = np.unpackbits(self.reached[row], count=len(graph_loader.compiled.names)).astype(bool)
+        return values, reached
+
+    def isochrone_data(self, graph_loader: MPKGraphLoader, regions_resolution: int, transfer_cfg: TransferConfig,
+                       max_times: list[int]) -> Optional[dict]:
+        # Same answer as map_utils.get_izochrone_data, None when the request is not covered
+        cell_bands = self.cell_bands(graph_loader, regions_resolution, transfer_cfg, max_times)
+        if cell_bands is None:
+            return None
+        max_times = self.params['max_times']
+        regions = get_region_store().regions(regions_resolution)
+        reached_cells = np.flatnonzero(cell_bands < len(max_times))
+        return {
+            'resolution': regions_resolution,
+            'max_times': max_times,
+            'colors': _get_colors_from_cmap(max_times, vmin=min(max_times), vmax=max(max_times)),
+            'cells': regions.index[reached_cells].tolist(),
+            'bands': cell_bands[reached_cells].tolist(),
+            'start_stops': _get_start_ids(graph_loader, transfer_cfg),
+        }
+
+    def map_data(self, graph_loader: MPKGraphLoader, regions_resolution: int,
+                 transfer_cfg: TransferConfig) -> Optional[dict]:
+        # Same answer as map_utils.get_map_data, None when the request is not covered
+        coverage = self.coverage(graph_loader, regions_resolution, transfer_cfg)
+        if coverage is None:
+            return None
+        values, reached = coverage
+        regions = get_region_store().regions(regions_resolution)
+        filled_cells = np.flatnonzero(values)
+        return {
+            'resolution': regions_resolution,
+            'cells': regions.index[filled_cells].tolist(),
+            'values': np.round(values[filled_cells], 4).tolist(),
+            'reached_stops': np.flatnonzero(reached).tolist(),
+            'start_stops': _get_start_ids(graph_loader, transfer_cfg),
+        }
+
+    def __row(self, graph_loader: MPKGraphLoader, regions_resolution: int,
+              transfer_cfg: TransferConfig) -> Optional[int]:
+        if transfer_cfg.departure_time is not None or regions_resolution != self.params['resolution'] \
+                or transfer_cfg.transfer_time != self.params['transfer_time']:
+            return None
+        start_ids = _get_start_ids(graph_loader, transfer_cfg)
+        return start_ids[0] if start_ids else None
+
+
+def _init_worker(loader_path: str):
+    global _worker_loader
+    _worker_loader = MPKGraphLoader.from_path(loader_path)
+    _worker_loader.attach_travel_matrices(loader_path)
+
+
+def _warm_rows(names: list[str], params: dict) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    resolution = params['resolution']
+    regions = get_region_store().regions(resolution)
+    name_cells = _get_name_cells(resolution, _worker_loader, regions)
+    bands, visited, reached = [], [], []
+    for name in names:
+        bands_cfg = TransferConfig(name, None, params['transfer_time'])
+        bands.append(_get_cell_bands(resolution, _worker_loader, bands_cfg, params['max_times'], regions))
+        reach_cfg = TransferConfig(name, params['max_time'], params['transfer_time'])
+        name_times = _worker_loader.compiled.name_times(_find_times_in_range(_worker_loader, reach_cfg))
+        reached_names = name_times <= params['max_time']
+        visited.append(np.bincount(name_cells[reached_names & (name_cells >= 0)], minlength=len(regions)))
+        reached.append(np.packbits(reached_names))
+    return (
+        np.array(bands, dtype=np.uint8),
+        np.array(visited, dtype=np.uint16),
+        np.array(reached, dtype=np.uint8),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute isochrone bands and default-map coverage of every '
+                                                 'stop for the default parameters, loaded by the app at startup.')
+    parser.add_argument('loaders', nargs='*', help=f'loader names, all of {", ".join(cfg.LOADER_PATHS)} by default')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, all cores by default')
+    args = parser.parse_args()
+
+    # Workers read the grid from data/regions; fetch it once here so they never geocode
+    get_region_store().regions(cfg.DEFAULT_REGIONS_RESOLUTION)
+    params = WarmResults.default_params()
+    for name in args.loaders or list(cfg.LOADER_PATHS):
+        loader_path = cfg.LOADER_PATHS[name]
+        start = time.perf_counter()
+        results = WarmResults.compute(loader_path, params, args.processes)
+        path = WarmResults.path_for(loader_path, MPKGraphLoader.from_path(loader_path).compiled)
+        results.save(path)
+        print(f'{path}: {len(results.bands)} stops in {time.perf_counter() - start:.1f} s')
+
+
+if __name__ == '__main__':
+    main()